@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 import multiprocessing
 import argparse
-import math
 import pickle
 import sys
+import numpy as np
 
 import lappdProtocol
+import lappdFile
 
 # Make a new tool
 parser = parser = argparse.ArgumentParser(description='Apply calibrations to offline binary events')
@@ -13,11 +14,13 @@ parser = parser = argparse.ArgumentParser(description='Apply calibrations to off
 # Custom args
 
 parser.add_argument('files', metavar="FILES", type=str, help="The files to calibrate", nargs='+')
-parser.add_argument('-T', '--threads', metavar="NUM_THREADS", type=int, help="Number of children run when processing pickled events. Number of processors - 1 is a good choice.", default=1)
-parser.add_argument('-s', '--subtract', metavar='PEDESTAL_FILE', type=str, help='Pedestal to subtract from pickled events.')
-parser.add_argument('-t', '--timing', metavar='TIMING_FILE', type=str, help='Time calibration to apply to pickled events -calibrated (results in seconds)')
-parser.add_argument('-g', '--gain', metavar='GAIN_FILE', type=str, help='Gain calibration to apply to pickled events.')
+parser.add_argument('-T', '--threads', metavar="NUM_THREADS", type=int, help="Number of children run when processing event files. Number of processors - 1 is a good choice.", default=1)
+parser.add_argument('-s', '--subtract', metavar='PEDESTAL_FILE', type=str, help='Pedestal to subtract from event files.')
+parser.add_argument('-t', '--timing', metavar='TIMING_FILE', type=str, help='Time calibration to apply to event files -calibrated (results in seconds)')
+parser.add_argument('-g', '--gain', metavar='GAIN_FILE', type=str, help='Gain calibration to apply to event files.')
 parser.add_argument('-d', '--dump', action='store_true', help='Dump the calibrated events to stdout. (works only with 1 thread!)')
+parser.add_argument('-C', '--chunk', metavar='EVENTS', type=int, help='Number of events calibrated at once.  (Bounds memory use)', default=1024)
+parser.add_argument('-U', '--unit', metavar='EVENTS', type=int, help='Number of events in a unit of work handed to a child.  (Files are split into units, so large files are shared by all children)', default=16384)
 
 # Get dem args
 args = parser.parse_args()
@@ -27,20 +30,103 @@ if args.dump and args.threads > 1:
     print("ERROR: Can only have one thread reporting to stdout.", file=sys.stderr)
     exit(1)
     
-# I'm sure theres a smart way to do this
-assignments = [[] for x in range(args.threads)]
-
-for n,file in enumerate(args.files):
-    assignments[n % args.threads].append(file)
-
-# Make an event queue
-eventQueue = multiprocessing.JoinableQueue()
+# Children take units of work, (file, first event, last event), from here
+# as they finish their previous ones, so nobody sits idle while there is work left
+workQueue = multiprocessing.Queue()
 
 from subprocess import run
 from os import getpid
 
+#
+# Calibrations as (channels x capacitors) arrays over a file's channels
+#
+def tables(header, pedestalCal, gainCal):
+
+    samples = header.num_samples
+    chans = header.chan_ids.tolist()
+
+    peds = None
+    if pedestalCal:
+        peds = np.full((len(chans), samples), np.nan)
+        for row, chan in enumerate(chans):
+            mean = pedestalCal.row(chan)[:samples]
+            peds[row, :len(mean)] = mean
+
+    gains = None
+    if gainCal:
+        # XXX This is hardcoded and lacks sophistication
+        # The gain calibration should technically have ALL the gains independently
+        # measured.
+        #
+        # It is a hack for A.21 to just use the TCAL gains as representative
+        # Its also completely wrong, so don't ever use -g for A21!
+        gains = np.array([[slope for slope, variance in gainCal[15 if chan < 16 else 55][:samples]] for chan in chans])
+
+    return peds, gains
+
+#
+# Calibrate a block of records (events x channels x samples) in one pass.
+# Missing and masked samples are NaN throughout, so they stay missing.
+#
+def calibrateBlock(records, header, out, peds, gains, timingCal):
+
+    events = len(records)
+    channels = len(header.chan_ids)
+    samples = header.num_samples
+
+    present = records['stops'] >= 0
+    stops = records['stops'].astype(np.intp)
+
+    amplitudes = records['amplitudes'].astype(np.float32)
+    if header.sample_type.kind == 'i':
+        amplitudes[records['amplitudes'] == lappdFile.sentinel(header.sample_type)] = np.nan
+
+    # Which capacitor each sample was held in
+    # (time ordered data starts at the stop)
+    if header.keep_offset:
+        capacitors = np.arange(samples)[None, None, :]
+    else:
+        capacitors = (np.arange(samples)[None, None, :] + stops[:, :, None]) % samples
+
+    rows = np.arange(channels)[None, :, None]
+
+    # Remove the pedestal
+    if not peds is None:
+        amplitudes -= peds[rows, capacitors]
+
+    # Now apply gains
+    if not gains is None:
+        amplitudes *= gains[rows, capacitors]
+
+    out['evt_number'] = records['evt_number']
+    out['partial'] = records['partial']
+    out['timestamp'] = records['timestamp']
+    out['stops'] = records['stops']
+
+    missing = lappdFile.sentinel(out.dtype['amplitudes'].base)
+    out['amplitudes'] = np.where(np.isnan(amplitudes), missing, amplitudes)
+
+    # Finally, apply timing
+    if timingCal:
+        calibration_rows = np.array([timingCal.rows[timingCal.chanmap[chan]] for chan in header.chan_ids.tolist()])[None, :, None]
+        times = np.where(capacitors < stops[:, :, None],
+                         timingCal.left[calibration_rows, capacitors],
+                         timingCal.right[calibration_rows, capacitors])
+        times[~present] = np.nan
+        out['times'] = times
+    elif header.timed:
+        out['times'] = records['times']
+
+#
+# What a calibrated file looks like (gains make the amplitudes fractional)
+#
+def calibratedHeader(header, args):
+    return lappdFile.header(header.board_id, header.resolution, header.keep_offset, header.timed or bool(args.timing),
+                            header.chan_ids, header.num_samples,
+                            '<f4' if args.gain or header.sample_type.kind == 'f' else header.sample_type)
+
 # Entry point for children
-def calibrate(assignments, eventQueue, args):
+def calibrate(workQueue, args):
 
     # Load the relevant calibrations
     pedestalCal = None
@@ -54,90 +140,78 @@ def calibrate(assignments, eventQueue, args):
     gainCal = None
     if args.gain:
         gainCal = pickle.load(open(args.gain, "rb"))
+
+    # The file we are currently working on
+    task = None
         
-    for task in assignments:
+    while True:
 
-        # Load the specific file
-        f = open(task, "rb")
-        print("Processing %s..." % task, file=sys.stderr)
+        unit = workQueue.get()
+
+        # No more work?
+        if unit is None:
+            break
+
+        # Load the specific file, if its new to us
+        if not unit[0] == task:
+            task = unit[0]
+            f = lappdFile.reader(task)
+            header = f.header
+            peds, gains = tables(header, pedestalCal, gainCal)
+            calibrated = calibratedHeader(header, args)
+
+            # The destination was laid out by the parent, we fill in our part of it
+            if not args.dump:
+                dest = lappdFile.reader("calibrated_%s" % task, 'r+')
+
+        task, first, last = unit
+        print("Processing %s events %d to %d..." % (task, first, last), file=sys.stderr)
+
+        for start in range(first, last, args.chunk):
+
+            stop = min(start + args.chunk, last)
+            records = f.records[start:stop]
+
+            # Did we want ascii?
+            if args.dump:
+                out = np.zeros(len(records), dtype=calibrated.record)
+                calibrateBlock(records, header, out, peds, gains, timingCal)
+                for record in out:
+                    lappdProtocol.dump(lappdFile.toEvent(calibrated, record))
+            else:
+                # Write the calibrated events straight into place
+                calibrateBlock(records, header, dest.records[start:stop], peds, gains, timingCal)
 
-        # Open the destination, we will write on the fly
-        if not args.dump:
-            dest = open("calibrated_%s" % task, "wb")
-
-        q = 0
-        while True:
-            
-            try:
-                # Get an event                    
-                e = pickle.load(f)
-                
-                # Get the channels present in this file's events
-                chans = e.channels.keys()
-
-                # Remove the pedestal
-                if pedestalCal:
-                    for chan in chans:
-                        # Because subtract usually operates on the data stream as it coming in
-                        # We need to do it manually here because there are usually None's present
-                        # after the fact...
-                        for i in range(len(e.channels[chan])):
-                            if not e.channels[chan][i] is None:
-                                e.channels[chan][i] -= pedestalCal.mean[chan][i]
-                                
-                # Now apply gains
-                if gainCal:
-                    for chan in chans:
-                        for i in range(1024):
-                            if e.channels[chan][i] is None:
-                                continue
-
-                            # XXX This is hardcoded and lacks sophistication
-                            # The gain calibration should technically have ALL the gains independently
-                            # measured.
-                            #
-                            # It is a hack for A.21 to just use the TCAL gains as representative
-                            # Its also completely wrong, so don't ever use -g for A21!
-                            e.channels[chan][i] *= gainCal[15 if chan < 16 else 55][i][0]
-
-
-                # Finally, apply timing
-                if timingCal:
-                    timingCal.apply(e)
-
-
-                # Did we want ascii?
-                if args.dump:
-                    lappdProtocol.dump(e)
-                else:
-                    # Write out the calibrated event
-                    pickle.dump(e, dest)
-
-                # now e gets garbage collected
-
-                # Print out a message every 256 events
-                if (q & 255) == 0:
-                    print("Processed %d events" % q, file=sys.stderr)
-
-                # Keep track
-                q += 1
-            except EOFError as e:
-
-                # Leave the loop
-                break
-            
-        # Close out the calibrated file
         if not args.dump:
-            print("DONE: calibrated_%s written" % file, file=sys.stderr)
-            dest.close()
+            dest.records.flush()
         
-# Fork a bunch of children that will handle sublists
+# Fork a bunch of children that will share the work
 if __name__ == '__main__':
 
+    # Split the files into units of work.
+    # Records are fixed size, so every unit knows exactly where its
+    # calibrated events go, and the outputs can be laid out up front.
+    for task in args.files:
+
+        f = lappdFile.reader(task)
+        print("%s: %d events" % (task, len(f)), file=sys.stderr)
+
+        if not args.dump:
+            lappdFile.allocate("calibrated_%s" % task, calibratedHeader(f.header, args), f.index)
+
+        for first in range(0, len(f), args.unit):
+            workQueue.put((task, first, min(first + args.unit, len(f))))
+
+        f.close()
+
+    # One stop sign for each child
+    for i in range(0, args.threads):
+        workQueue.put(None)
+
     calibrateProcesses = [None]*args.threads
 
     for i in range(0, args.threads):
-        calibrateProcesses[i] = multiprocessing.Process(target=calibrate, args=(assignments[i], eventQueue, args))
+        calibrateProcesses[i] = multiprocessing.Process(target=calibrate, args=(workQueue, args))
         calibrateProcesses[i].start()
 
         # Pin the processes
@@ -149,6 +223,7 @@ if __name__ == '__main__':
     # Wait for them to finish (in order)
     for i in range(0, args.threads):
         calibrateProcesses[i].join()
-        
 
-    
+    if not args.dump:
+        for task in args.files:
+            print("DONE: calibrated_%s written" % task, file=sys.stderr)
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+import argparse
+import pickle
+import sys
+
+# (events unpickle into lappdProtocol.event)
+import lappdProtocol
+import lappdFile
+
+# Make a new tool
+parser = argparse.ArgumentParser(description='Convert binary dumps of pickled events into indexed event files')
+
+parser.add_argument('files', metavar="FILES", type=str, help="The pickled dumps to convert", nargs='+')
+parser.add_argument('-p', '--prefix', metavar='PREFIX', type=str, help='Prefix of the converted files', default='converted_')
+parser.add_argument('-F', '--float', action='store_true', help='Store amplitudes as 32-bit floats, instead of integer ADC counts.  (Needed for gain calibrated dumps)')
+
+# Get dem args
+args = parser.parse_args()
+
+for task in args.files:
+
+    print("Converting %s..." % task, file=sys.stderr)
+
+    f = open(task, "rb")
+    dest = None
+    q = 0
+
+    # Pickled dumps can only be read from the start, until they run out
+    while True:
+        try:
+            e = pickle.load(f)
+        except EOFError:
+            break
+
+        # The header is made from the first event
+        if not dest:
+            dest = lappdFile.writer(open("%s%s" % (args.prefix, task), "wb"), None, '<f4' if args.float else None)
+
+        dest.write(e)
+        q += 1
+
+        if (q & 1023) == 0:
+            print("Converted %d events" % q, file=sys.stderr)
+
+    f.close()
+
+    if dest:
+        dest.close()
+        print("DONE: %s%s written (%d events)" % (args.prefix, task, q), file=sys.stderr)
+    else:
+        print("%s held no events, skipping" % task, file=sys.stderr)
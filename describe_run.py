@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+import argparse
+import sys
+import numpy as np
+
+import lappdFile
+
+#
+# Describes a recorded run, without reading any more of it than needed
+#
+parser = argparse.ArgumentParser(description='Describe recorded event files')
+
+parser.add_argument('files', metavar="FILES", type=str, help="The event files to describe", nargs='+')
+parser.add_argument('-r', '--range', metavar=('FIRST', 'LAST'), type=int, nargs=2, help='Only describe records FIRST up to (not including) LAST')
+parser.add_argument('-e', '--event', metavar='EVT_NUMBER', type=int, help='Only describe records with this event number')
+
+args = parser.parse_args()
+
+for path in args.files:
+
+    run = lappdFile.reader(path)
+    header = run.header
+
+    print("# File: %s" % path)
+    print("# Board: %s" % header.board_id.hex())
+    print("# Resolution: %d-bit, %s ordered%s" % (1 << header.resolution, "capacitor" if header.keep_offset else "time", ", timed" if header.timed else ""))
+    print("# Channels: %s" % " ".join(map(str, header.chan_ids.tolist())))
+    print("# Samples: %d, stored as %s" % (header.num_samples, header.sample_type.str))
+    print("# Events: %d" % len(run))
+
+    # Pick out the records we are interested in
+    records = run.records
+    if args.range:
+        records = records[args.range[0]:args.range[1]]
+    if not args.event is None:
+        records = run.records[run.find(args.event)]
+
+    if not len(records):
+        print("")
+        continue
+
+    timestamps = records['timestamp']
+    print("# Described: %d (%d partial)" % (len(records), np.count_nonzero(records['partial'])))
+    print("# Event numbers: %d to %d" % (records['evt_number'].min(), records['evt_number'].max()))
+    print("# Timestamps: %d to %d" % (timestamps.min(), timestamps.max()))
+
+    # Per channel amplitude summary (missing and masked samples left out)
+    # accumulated a chunk of records at a time, so big runs aren't read in at once
+    nchan = len(header.chan_ids)
+    present = np.zeros(nchan, dtype=np.int64)
+    count = np.zeros(nchan, dtype=np.int64)
+    total = np.zeros(nchan)
+    squares = np.zeros(nchan)
+    smallest = np.full(nchan, np.inf)
+    largest = np.full(nchan, -np.inf)
+
+    for start in range(0, len(records), 1024):
+        chunk = records[start:start + 1024]
+        present += np.count_nonzero(chunk['stops'] >= 0, axis=0)
+
+        amplitudes = chunk['amplitudes'].astype(np.float64)
+        if header.sample_type.kind == 'i':
+            amplitudes[chunk['amplitudes'] == run.missing] = np.nan
+
+        # (channels first)
+        amplitudes = amplitudes.transpose(1, 0, 2).reshape(nchan, -1)
+        valid = ~np.isnan(amplitudes)
+        count += np.count_nonzero(valid, axis=1)
+        total += np.nansum(amplitudes, axis=1)
+        squares += np.nansum(amplitudes**2, axis=1)
+        smallest = np.fmin(smallest, np.where(valid, amplitudes, np.inf).min(axis=1))
+        largest = np.fmax(largest, np.where(valid, amplitudes, -np.inf).max(axis=1))
+
+    print("# chan present mean std min max")
+    for row, chan in enumerate(header.chan_ids.tolist()):
+
+        if not count[row]:
+            print("%d %d nan nan nan nan" % (chan, present[row]))
+            continue
+
+        mean = total[row]/count[row]
+        std = np.sqrt(max(squares[row]/count[row] - mean*mean, 0.0))
+        print("%d %d %e %e %e %e" % (chan, present[row], mean, std, smallest[row], largest[row]))
+
+    # Break on file
+    print("")
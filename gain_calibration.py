@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import numpy as np
+import queue
 import sys
 import time
 
@@ -17,6 +18,8 @@ parser = lappdTool.create("Measure per capacitor gain slopes between two given v
 # These default values calibrate pretty well
 parser.add_argument('low', metavar='LOW', type=float, default=0.7, help='Use this as the low voltage sample')
 parser.add_argument('high', metavar='HIGH', type=float, default=1, help='Use this value as the high voltage sample')
+parser.add_argument('-b', '--block', metavar='BLOCK', type=int, default=256, help='With --precision, take this many events at each voltage before checking again')
+lappdTool.convergence(parser, 'relative, e.g. 0.001')
 
 # Handle common configuration due to the common arguments
 ifc, args, eventQueue = lappdTool.connect(parser)
@@ -39,111 +42,136 @@ if __name__ == "__main__":
 # Tell the user what we are dusering
 print("# CMOFS: %f\n# TCAL_low: %f\n# TCAL_high: %f\n# ROFS: %f" % (args.cmofs, args.low, args.high, args.rofs))
 
-# Define an event list
-evts = []
-
+# Per capacitor statistics at each voltage, updated as events arrive
+# (so memory does not grow with the number of events)
+stats = {}
+taken = {}
 for voltage in (args.low, args.high):
-    # Set the low value
-    ifc.DacSetVout(lappdTool.DAC_TCAL_N1, voltage)
-    ifc.DacSetVout(lappdTool.DAC_TCAL_N2, voltage)
-
-    # Give some output
-    print("Receiving data for TCAL_N = %f" % voltage, file=sys.stderr)
-
-    k = samples
-    # Take N samples at both low and high
-    while k > 0:
-        # Wait for it to settle
-        time.sleep(args.i)
-
-        # Software trigger
-        ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
-
-        # Wait for the event
-        try:
-            evt = eventQueue.get(timeout=args.i)
-        except:
-            print("Timed out...", file=sys.stderr)
-            continue
-        
-        # Add some info and stash it
-        evt.voltage = voltage
-        evts.append(evt)
-        k -= 1
-        
-        
-############# BEGIN COMMON TOOL FOOTER
+    stats[voltage] = lappdProtocol.accumulator()
+    taken[voltage] = 0
 
-# Once we have all the events we need, go ahead and reap the listeners.
-# If not, you are going to possible fill up with tons of hardware triggers
-# and choke out.
+# The slope denominator
+run = args.high - args.low
 
-# Reap listeners
-lappdTool.reap(intakeProcesses, args)
+# Sample variance of each capacitor (NaN without at least two samples)
+def variance(acc):
+    return np.where(acc.count > 1, acc.m2/np.maximum(acc.count - 1, 1), np.nan)
 
-############# END COMMON TOOL FOOTER 
+#
+# Reciprocal slopes, and the standard error of the difference in means
+# (scaled by the run), from what we have so far
+#
+def estimate():
 
-# Get the channel list
-# (the * expands the iterator)
-chans = [*evts[0].channels.keys()]
+    low = stats[args.low]
+    high = stats[args.high]
 
-# The slope denominator
-run = args.high - args.low
+    with np.errstate(divide='ignore', invalid='ignore'):
 
-# Iterate over channels, because we want response curves per channel
-chans = evts[0].channels.keys()
+        # Capacitors that never saw an unmasked sample have no mean
+        mean_low = np.where(low.count > 0, low.mean, np.nan)
+        mean_high = np.where(high.count > 0, high.mean, np.nan)
 
-caps_low = {}
-caps_high = {}
-slopes = {}
+        # Now make the slopes and propogated RMSs
+        ampl_variance = np.sqrt(variance(high)/high.count + variance(low)/low.count)/run
+        recip_k = run/(mean_high - mean_low)
 
-from scipy.stats import describe
-import math
+    return recip_k, ampl_variance
 
-for chan in chans:
-    
-    # Now prepare to store the average gains
-    caps_low[chan] = [[] for x in range(1024)]
-    caps_high[chan] = [[] for x in range(1024)]
-    slopes[chan] = [[] for x in range(1024)]
-    
-    # Filter out any masked capacitors
-    for evt in evts:
-
-        # In case the order is wonky for some reason?
-        if evt.voltage == args.high:
-            caps = caps_high[chan]
-        else:
-            caps = caps_low[chan]
-
-        # Save this data point (filtering out Nones)
-        for cap in range(1024):
-            if evt.channels[chan][cap] is None:
+# Without a target precision, just take N at each voltage in one go.
+# Otherwise, go back and forth between the voltages a block at a time
+# until we know the slopes well enough (or have taken N at each).
+block = min(args.block, samples) if args.precision else samples
+
+while True:
+
+    for voltage in (args.low, args.high):
+
+        # Set the voltage
+        ifc.DacSetVout(lappdTool.DAC_TCAL_N1, voltage)
+        ifc.DacSetVout(lappdTool.DAC_TCAL_N2, voltage)
+
+        # Throw away anything that showed up late from the last voltage,
+        # so it doesn't get counted at this one
+        while True:
+            try:
+                eventQueue.get(block=False)
+            except queue.Empty:
+                break
+            eventQueue.task_done()
+
+        # Give some output
+        print("Receiving data for TCAL_N = %f" % voltage, file=sys.stderr)
+
+        k = min(block, samples - taken[voltage])
+        taken[voltage] += k
+
+        # Take the samples at this voltage
+        while k > 0:
+            # Wait for it to settle
+            time.sleep(args.i)
+
+            # Software trigger
+            ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
+
+            # Wait for the event
+            try:
+                evt = eventQueue.get(timeout=args.i)
+            except queue.Empty:
+                print("Timed out...", file=sys.stderr)
+                continue
+
+            # Partial events (--stale export) are missing channels, so they can't be used
+            if evt.partial:
+                print("Skipping partial event %d" % evt.evt_number, file=sys.stderr)
+                eventQueue.task_done()
                 continue
-            
-            # Record it
-            caps[cap].append(evt.channels[chan][cap])
 
-    # Now caps are nicely sorted, take averages and std deviations
-    for cap in range(1024):
+            # Fold it into the statistics for the voltage it was taken at
+            stats[voltage].add(evt)
+            eventQueue.task_done()
+            k -= 1
 
-        # Replace the lists with tuples containing the statistical dirt
-        caps_high[chan][cap] = describe(caps_high[chan][cap])
-        caps_low[chan][cap] = describe(caps_low[chan][cap])
+    # Are the slopes known well enough yet?
+    # (relative standard error of each reciprocal slope)
+    if args.precision:
+        recip_k, ampl_variance = estimate()
+        errors = np.abs(recip_k)*ampl_variance
 
-        # Now make the slopes and propogated RMSs
-        varhigh = caps_high[chan][cap].variance
-        varlow = caps_low[chan][cap].variance
+        lappdTool.progress(errors, stats[args.low].chan_ids.tolist(), args)
+        if lappdTool.converged(errors, args):
+            print("Converged after %d events per voltage" % taken[args.low], file=sys.stderr)
+            break
 
-        ampl_variance = math.sqrt(caps_high[chan][cap].variance + caps_low[chan][cap].variance)/(run*math.sqrt(samples))
-        recip_k = run/(caps_high[chan][cap].mean - caps_low[chan][cap].mean)
-        
-        # We want recriprocal slopes
-        slopes[chan][cap] = ( recip_k, recip_k**2 * ampl_variance)
+    # Have we taken everything we were going to?
+    if taken[args.low] >= samples and taken[args.high] >= samples:
+        if args.precision:
+            print("WARNING: Did not reach the requested precision within %d events per voltage" % samples, file=sys.stderr)
+        break
+
+############# BEGIN COMMON TOOL FOOTER
+
+# Once we have all the events we need, go ahead and reap the listeners.
+# If not, you are going to possible fill up with tons of hardware triggers
+# and choke out.
+
+# Reap listeners
+lappdTool.reap(intakeProcesses, args)
+
+############# END COMMON TOOL FOOTER 
+
+low = stats[args.low]
+recip_k, ampl_variance = estimate()
+
+# We want recriprocal slopes
+# (stored as a list of (slope, variance) per capacitor, for each channel)
+slopes = {}
+for row, chan in enumerate(low.chan_ids.tolist()):
+    slopes[chan] = list(zip(recip_k[row].tolist(), (recip_k[row]**2 * ampl_variance[row]).tolist()))
 
 # Output a correction file
 import pickle
-pickle.dump(slopes, open("%s.gains" % evts[0].board_id.hex(), "wb"))
+pickle.dump(slopes, open("%s.gains" % low.board_id.hex(), "wb"))
     
 # Now output the results
 for channel, results in slopes.items():
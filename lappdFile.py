@@ -0,0 +1,407 @@
+#!/usr/bin/python3
+
+#
+# Binary event files
+#
+# Replaces streaming pickled events one after another.  Every event in a
+# file has the same channels and the same number of samples, so events are
+# stored as fixed size records, and any of them can be found by seeking.
+#
+# Layout (everything little endian):
+#
+#  HEADER
+#   MAGIC (8 bytes) - b'LAPPDEVT'
+#   VERSION (16 bits)
+#   RESOLUTION (8 bits) - the event resolution (2^RESOLUTION bits per sample)
+#   FLAGS (8 bits)
+#    ---> KEEP_OFFSET (bit 0) - capacitor ordered (else time ordered)
+#    ---> TIMED (bit 1) - records carry a time axis
+#   BOARD_ID (48 bits)
+#   NUM_CHANNELS (16 bits)
+#   NUM_SAMPLES (16 bits)
+#   SAMPLE_TYPE (4 bytes) - NumPy type string of stored amplitudes, e.g. '<i2'
+#   NUM_EVENTS (64 bits) - zero until the file is closed
+#   INDEX_OFFSET (64 bits) - where the index starts, zero until the file is closed
+#   CHANNELS (16 bits x NUM_CHANNELS) - channel identifier of each row
+#  ------------------------------------ (padded to a multiple of 8 bytes)
+#
+#  RECORDS (NUM_EVENTS of them, back to back)
+#   EVT_NUMBER (32 bits)
+#   PARTIAL (8 bits)
+#   RESERVED (24 bits)
+#   TIMESTAMP (64 bits)
+#   STOPS (16 bits x NUM_CHANNELS) - stop sample of each row, -1 if the channel is missing
+#   AMPLITUDES (SAMPLE_TYPE x NUM_CHANNELS x NUM_SAMPLES) - the smallest value of integer types marks a missing/masked sample
+#   TIMES (64-bit float x NUM_CHANNELS x NUM_SAMPLES) - only if TIMED
+#
+#  INDEX (one entry per record)
+#   EVT_NUMBER (32 bits)
+#   TIMESTAMP (64 bits)
+#
+# If a file was never closed (the writer was killed), the index is missing,
+# and the reader rebuilds it from the records that made it to disk.
+#
+import numpy as np
+import struct
+import sys
+
+import lappdProtocol
+
+globals()['FILE_MAGIC'] = b'LAPPDEVT'
+globals()['FILE_VERSION'] = 1
+
+headerstruct = struct.Struct("<8sHBB6sHH4sQQ")
+
+indextype = np.dtype([('evt_number', '<u4'), ('timestamp', '<u8')])
+
+# The start of every record
+prefixtype = np.dtype([('evt_number', '<u4'), ('partial', 'u1'), ('reserved', 'V3'), ('timestamp', '<u8')])
+
+#
+# Amplitudes arrive as floats (so they can be NaN), but the data itself
+# is integer ADC counts (even after subtracting the integer pedestals).
+# Store it as the narrowest integer that holds the resolution.
+#
+def sampleType(resolution):
+    return np.dtype('<i2') if resolution <= 4 else np.dtype('<i4') if resolution == 5 else np.dtype('<i8')
+
+#
+# The value standing in for NaN
+#
+def sentinel(sample_type):
+    return np.iinfo(sample_type).min if sample_type.kind == 'i' else np.nan
+
+#
+# The fixed layout of a record
+#
+def recordType(num_channels, num_samples, sample_type, timed):
+
+    fields = prefixtype.descr + [
+              ('stops', '<i2', (num_channels,)),
+              ('amplitudes', sample_type, (num_channels, num_samples))]
+
+    if timed:
+        fields.append(('times', '<f8', (num_channels, num_samples)))
+
+    return np.dtype(fields)
+
+#
+# What a file holds, as recorded in its header
+#
+class header(object):
+
+    def __init__(self, board_id, resolution, keep_offset, timed, chan_ids, num_samples, sample_type, num_events=0, index_offset=0):
+        self.board_id = board_id
+        self.resolution = resolution
+        self.keep_offset = keep_offset
+        self.timed = timed
+        self.chan_ids = np.asarray(chan_ids, dtype=np.int16)
+        self.num_samples = num_samples
+        self.sample_type = np.dtype(sample_type)
+        self.num_events = num_events
+        self.index_offset = index_offset
+
+        # Record layout
+        self.record = recordType(len(self.chan_ids), num_samples, self.sample_type, timed)
+
+        # Where the records start
+        self.size = headerstruct.size + 2*len(self.chan_ids)
+        self.size += -self.size % 8
+
+        # Channel -> row
+        self.rows = {chan : row for row, chan in enumerate(self.chan_ids.tolist())}
+
+    def pack(self):
+
+        flags = (1 if self.keep_offset else 0) | (2 if self.timed else 0)
+        raw = headerstruct.pack(FILE_MAGIC, FILE_VERSION, self.resolution, flags, self.board_id,
+                                len(self.chan_ids), self.num_samples, self.sample_type.str.encode().ljust(4),
+                                self.num_events, self.index_offset)
+        raw += self.chan_ids.astype('<i2').tobytes()
+        return raw.ljust(self.size, b'\x00')
+
+    def unpack(f):
+
+        raw = f.read(headerstruct.size)
+        if len(raw) < headerstruct.size:
+            raise Exception("File is too short to be an event file")
+
+        magic, version, resolution, flags, board_id, num_channels, num_samples, sample_type, num_events, index_offset = headerstruct.unpack(raw)
+
+        if not magic == FILE_MAGIC:
+            raise Exception("Not an event file (old pickled dumps can be converted with convert_dump.py)")
+
+        if version > FILE_VERSION:
+            raise Exception("Event file version %d is newer than this reader (version %d)" % (version, FILE_VERSION))
+
+        chan_ids = np.frombuffer(f.read(2*num_channels), dtype='<i2')
+
+        return header(board_id, resolution, bool(flags & 1), bool(flags & 2), chan_ids, num_samples,
+                      sample_type.decode().strip(), num_events, index_offset)
+
+#
+# Writes events to an open (binary) file.
+#
+# The header is taken from the first event written, so every later event
+# must have the same number of samples, and a subset of its channels
+# (or of chan_ids, if they are known up front).  Events without a single
+# channel (partial events that timed out early) say nothing about either,
+# so they wait for one that does (or, failing that, take the full DRS4 window).
+#
+class writer(object):
+
+    def __init__(self, f, chan_ids=None, sample_type=None, num_samples=None):
+        self.f = f
+        self.chan_ids = chan_ids
+        self.sample_type = sample_type
+        self.num_samples = num_samples
+        self.header = None
+        self.index = []
+
+        # Hit-less events written before there was a header
+        self.held = []
+
+    def begin(self, anevent):
+
+        sample_type = np.dtype(self.sample_type) if self.sample_type else sampleType(anevent.resolution)
+
+        chan_ids = anevent.chan_ids.copy() if self.chan_ids is None else self.chan_ids
+
+        # A hit-less event has no samples to go by
+        num_samples = self.num_samples
+        if num_samples is None:
+            num_samples = anevent.amplitudes.shape[1] if len(anevent.chan_ids) else 1024
+
+        self.start(header(anevent.board_id, anevent.resolution, anevent.keep_offset, not anevent.times is None,
+                          chan_ids, num_samples, sample_type))
+
+    #
+    # Write the header (if you have one already, rather than an event to make it from)
+    #
+    def start(self, aheader):
+
+        self.header = aheader
+        self.f.write(self.header.pack())
+
+        # One record, reused for every event
+        self.record = np.zeros(1, dtype=self.header.record)[0]
+        self.missing = sentinel(self.header.sample_type)
+
+    def write(self, anevent):
+
+        if self.header is None:
+            if not len(anevent.chan_ids) and self.chan_ids is None:
+                self.held.append(anevent)
+                return
+
+            self.begin(anevent)
+
+            held, self.held = self.held, []
+            for old in held:
+                self.write(old)
+
+        if len(anevent.chan_ids) and not anevent.amplitudes.shape[1] == self.header.num_samples:
+            raise Exception("Event %d has %d samples, the file has %d" % (anevent.evt_number, anevent.amplitudes.shape[1], self.header.num_samples))
+
+        if not (anevent.times is None) == (not self.header.timed):
+            raise Exception("Event %d does not match the file's timing calibration" % anevent.evt_number)
+
+        try:
+            rows = [self.header.rows[chan] for chan in anevent.chan_ids.tolist()]
+        except KeyError as e:
+            raise Exception("Event %d has channel %d, which is not in the file" % (anevent.evt_number, e.args[0]))
+
+        record = self.record
+        record['evt_number'] = anevent.evt_number
+        record['partial'] = anevent.partial
+        record['timestamp'] = anevent.timestamp
+
+        # Channels that didn't make it stay missing
+        record['stops'][:] = -1
+        record['amplitudes'][:] = self.missing
+        if rows:
+            record['stops'][rows] = anevent.stops
+            record['amplitudes'][rows] = np.where(anevent.masked, self.missing, anevent.amplitudes)
+
+            if self.header.timed:
+                record['times'][rows] = anevent.times
+
+        self.f.write(record.tobytes())
+        self.index.append((anevent.evt_number, anevent.timestamp))
+
+    #
+    # Write a block of records laid out as self.header.record
+    #
+    def extend(self, records):
+
+        if not records.dtype == self.header.record:
+            raise Exception("Records do not match the file's layout")
+
+        self.f.write(records.tobytes())
+        self.index.extend(zip(records['evt_number'].tolist(), records['timestamp'].tolist()))
+
+    #
+    # Write the index and fill in the header
+    # (safe to call more than once)
+    #
+    def close(self):
+
+        # Already closed
+        if self.f.closed:
+            return
+
+        # Nothing but hit-less events
+        if self.held:
+            self.begin(self.held[0])
+
+            held, self.held = self.held, []
+            for old in held:
+                self.write(old)
+
+        if not self.header is None:
+            self.header.num_events = len(self.index)
+            self.header.index_offset = self.f.tell()
+            self.f.write(np.array(self.index, dtype=indextype).tobytes())
+
+            self.f.seek(0)
+            self.f.write(self.header.pack())
+
+        self.f.close()
+
+#
+# Lay out a complete file, with space for every record, to be filled in
+# later (in any order, by any number of processes) through reader(path, 'r+')
+#
+def allocate(path, aheader, index):
+
+    aheader.num_events = len(index)
+    aheader.index_offset = aheader.size + len(index)*aheader.record.itemsize
+
+    with open(path, "wb") as f:
+        f.write(aheader.pack())
+        f.seek(aheader.index_offset)
+        f.write(np.asarray(index, dtype=indextype).tobytes())
+
+#
+# Make an event out of a record, laid out as described by aheader
+#
+def toEvent(aheader, record):
+
+    present = record['stops'] >= 0
+    everything = present.all()
+    stored = record['amplitudes'] if everything else record['amplitudes'][present]
+
+    # Already in the right form?  Then just look at it.
+    if stored.dtype == lappdProtocol.sampleType(aheader.resolution):
+        amplitudes = stored
+    else:
+        amplitudes = stored.astype(lappdProtocol.sampleType(aheader.resolution))
+        if aheader.sample_type.kind == 'i':
+            amplitudes[stored == sentinel(aheader.sample_type)] = np.nan
+
+    times = None
+    if aheader.timed:
+        times = record['times'] if everything else record['times'][present]
+
+    return lappdProtocol.event(int(record['evt_number']), aheader.board_id, aheader.resolution, aheader.keep_offset,
+                               aheader.chan_ids[present], amplitudes, record['stops'][present],
+                               bool(record['partial']), None, times, int(record['timestamp']))
+
+#
+# Reads events back out of a file.
+#
+# The file is memory mapped, so nothing is read until it is touched:
+#
+#   run = reader("fancyrun_...")
+#   run[12]                          - one event
+#   run[1000:2000]                   - a list of events
+#   run.records[1000:2000]           - the raw records, as zero-copy views into the file
+#   run.find(513)                    - indices of records with this event number
+#   run.between(t0, t1)              - indices of records with t0 <= timestamp < t1
+#   run.events(indices)              - events for any indices
+#   for chunk in run.chunks(1024)    - lists of events, 1024 at a time
+#
+# The mapping is copy-on-write, so events can be modified in place (e.g. calibrated)
+# without touching the file.  (Unless mode='r+', for filling in allocated files.)
+#
+class reader(object):
+
+    def __init__(self, path, mode='c'):
+
+        self.path = path
+        self.mode = mode
+        with open(path, "rb") as f:
+            self.header = header.unpack(f)
+            f.seek(0, 2)
+            size = f.tell()
+
+        self.missing = sentinel(self.header.sample_type)
+
+        # A file that was never closed has no index,
+        # so take whatever complete records made it to disk
+        closed = self.header.index_offset > 0
+        if not closed:
+            self.header.num_events = (size - self.header.size) // self.header.record.itemsize
+            print("%s was not closed, recovered %d events" % (path, self.header.num_events), file=sys.stderr)
+
+        self.records = self.map(self.header.record, self.header.size, self.header.num_events)
+
+        if closed:
+            self.index = self.map(indextype, self.header.index_offset, self.header.num_events)
+        else:
+            self.index = np.empty(self.header.num_events, dtype=indextype)
+            self.index['evt_number'] = self.records['evt_number']
+            self.index['timestamp'] = self.records['timestamp']
+
+    def map(self, dtype, offset, count):
+
+        # (mmap can't map nothing)
+        if not count:
+            return np.empty(0, dtype=dtype)
+
+        return np.memmap(self.path, dtype=dtype, mode=self.mode, offset=offset, shape=(count,))
+
+    def __len__(self):
+        return self.header.num_events
+
+    def event(self, record):
+        return toEvent(self.header, record)
+
+    def events(self, indices):
+        return [self.event(record) for record in self.records[indices]]
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return self.events(i)
+
+        return self.event(self.records[i])
+
+    def __iter__(self):
+        for record in self.records:
+            yield self.event(record)
+
+    #
+    # Where are the records for this event number?
+    # (event numbers are only 16 bits on the wire, so long runs repeat them)
+    #
+    def find(self, evt_number):
+        return np.flatnonzero(self.index['evt_number'] == evt_number)
+
+    #
+    # Where are the records with start <= timestamp < stop?
+    #
+    def between(self, start, stop):
+        timestamps = self.index['timestamp']
+        return np.flatnonzero((timestamps >= start) & (timestamps < stop))
+
+    #
+    # Events in fixed size chunks
+    #
+    def chunks(self, size=1024):
+        for start in range(0, len(self), size):
+            yield self.events(slice(start, start + size))
+
+    def close(self):
+        self.records = None
+        self.index = None
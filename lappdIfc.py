@@ -4,6 +4,7 @@ import sys
 import os
 import eevee 
 import time
+import pickle
 import numpy as np
 
 # temporarily here
@@ -57,6 +58,10 @@ DRSSTOPSAMPLE_0 = 0x0650 # stop sample for chan 0 (for ith channel + 4*i)
 ADCCHANMASK_0   = 0x0670 # mask of ADC channels to be sent 
 NUDPPORTS       = 0x0678 # number of UDP ports for multiple ports mode 
 
+# EEVEE register transactions are 8 bytes each (4 address, 4 value)
+# so batches of 2^7 fit comfortably inside an Ethernet MTU
+BATCHSIZE       = 128
+
 
 
 ###################################
@@ -100,6 +105,16 @@ class lappdInterface :
         self.mask_adc1 = 1 << 15;
         self.mask_adc2 = 1 << 23;
 
+        # register transactions sent so far (for calibration bookkeeping)
+        self.ntrans = 0
+
+        # IDELAY calibration results, as cached by SaveIDelays()
+        # frame delays {nadc : dly}, data delays {(nadc, chn) : dly},
+        # and the bitslip masks written to each ADC, in order {nadc : [mask, ...]}
+        self.frame_dly = {}
+        self.data_dly = {}
+        self.bitslips = {}
+
         # dict for DAC voltages 'name' : [OUTN, VOLTS] 
         self.DACOUTS = {
             'BIAS'     : 0, 
@@ -115,12 +130,31 @@ class lappdInterface :
     def RegRead(self, addr) :
         if type(addr) != int : addr = int(addr,0)
         val = self.brd.peeknow(addr)
+        self.ntrans += 1
         return val
 
+    # read many registers, one transaction per batch of peeks
+    # (values come back as a numpy array, in the order requested)
+    def RegReadMany(self, addrs) :
+        vals = np.empty(len(addrs), dtype=np.int64)
+        for first in range(0, len(addrs), BATCHSIZE) :
+            for addr in addrs[first:first + BATCHSIZE] :
+                self.brd.peek(addr)
+            vals[first:first + BATCHSIZE] = self.Transact()
+        return vals
+
+    # send everything queued on the board, and return the values read back
+    # (responses are (address, value) pairs, in the order they were queued)
+    # if addr is given, only the values at that address are returned
+    def Transact(self, addr = None) :
+        self.ntrans += 1
+        return [val for a, val in self.brd.transact() if addr is None or a == addr]
+
     def RegWrite(self, addr, value) :
         if type(addr)  != int : addr  = int(addr,0)
         if type(value) != int : value = int(value,0)
         self.brd.pokenow(addr, value)
+        self.ntrans += 1
         return 0
 
     # modify only one bit of the register 
@@ -134,6 +168,7 @@ class lappdInterface :
         else :
             reg_val = reg_val & (~(1 << bit))
         self.brd.pokenow(addr, reg_val)
+        self.ntrans += 2
 
 
     def SetAdcReg(self, nadc, reg, val):
@@ -149,6 +184,7 @@ class lappdInterface :
 
         # bit 10 in micaroblase addr space - select adc chip : 0 -- ADC-1, 1-- ADC-2
         self.brd.pokenow(0x2000 | (nadc << 10) | (reg << 2), val)
+        self.ntrans += 1
     
     def GetAdcReg(self, nadc, reg):
         if reg < 0 or reg > 0xff :
@@ -159,6 +195,7 @@ class lappdInterface :
         self.brd.pokenow(0x2000, 2)
         val = self.brd.peeknow(0x2000 | (nadc << 10) | (reg << 2))
         self.brd.pokenow(0x2000, 0)
+        self.ntrans += 3
         print(hex(val), file=sys.stderr)
         return val
 
@@ -256,105 +293,322 @@ class lappdInterface :
             raise Exception('error: wrong SER_DATA_RATE value')
 
     def CalibrateIDelaysFrameAll(self) :
-        frame_dly = [0,0]
-        for iadc in range(0,2) :
-            print("calibrate frame IDELAY for ADC #%d"%(iadc), file=sys.stderr)
-            frame_dly[iadc] = self.CalibrateIDelayFrame(iadc)
+        print("calibrate frame IDELAYs for ADC #0 and #1", file=sys.stderr)
+        frame_dly = self.CalibrateIDelayFrames([0,1])
+        self.frame_dly = frame_dly
         for iadc in range(0,2) :
-            self.RegWrite(ADCFRAMEDELAY_0 + iadc*4, frame_dly[iadc])
+            self.brd.poke(ADCFRAMEDELAY_0 + iadc*4, frame_dly[iadc])
+        self.Transact()
         # reset bitslips for ISERDESEs on data lines
         self.RegSetBit(CMD, C_CMD_RESET_BIT, 1)
 
     def CalibrateIDelaysDataAll(self) :
+        print("calibrate data IDELAYs for ADC #0 and #1", file=sys.stderr)
+        ret = self.CalibrateIDelaysData([0,1])
         for iadc in range(0,2) :
-            print("calibrate data IDELAYs for ADC #%d"%(iadc), file=sys.stderr)
-            ret = self.CalibrateIDelaysData(iadc)
             self.AdcSetTestMode(iadc, 'normal')
-            if not ret:
-                raise Exception('ADC calibration failed')
+        if not ret:
+            raise Exception('ADC calibration failed')
 
+    # nadc can be one ADC, or a list of them to calibrate together
     def CalibrateIDelaysData(self, nadc)  :
-        self.AdcSetTestMode(nadc, 'custom')
+        nadcs = [nadc] if type(nadc) == int else list(nadc)
+        for iadc in nadcs :
+            self.AdcSetTestMode(iadc, 'custom')
+            self.bitslips[iadc] = []
+        # alternate ADCs, so their lanes share transactions
+        lanes = [(iadc, chn) for chn in range(16) for iadc in nadcs]
         itr = 0
         while itr < 10:
-            bitslp = 0
-            for chn in range(16) : 
-                res = self.CalibrateIDelaySingle(nadc, chn)
-                x = int(not res) << chn
-                bitslp = bitslp | x
-                #print(bin(bitslp))
+            res = self.CalibrateIDelayLanes(lanes)
+            # only the lanes that failed get another try
+            lanes = [lane for lane in lanes if not res[lane]]
             itr = itr + 1
-            if bitslp == 0 : 
+            if len(lanes) == 0 : 
                 print('Calibration OK', file=sys.stderr)
-                self.AdcSetTestMode(nadc, 'normal')
+                for iadc in nadcs :
+                    self.AdcSetTestMode(iadc, 'normal')
                 return True
             else :
-                print('One more try with bitslip %s' % (bin(bitslp)), file=sys.stderr)
-                self.RegWrite(BITSLIP+nadc*4, bitslp)
+                for iadc in nadcs :
+                    bitslp = 0
+                    for ladc, chn in lanes :
+                        if ladc == iadc : bitslp = bitslp | (1 << chn)
+                    if bitslp != 0 :
+                        print('One more try for ADC #%d with bitslip %s' % (iadc, bin(bitslp)), file=sys.stderr)
+                        self.RegWrite(BITSLIP+iadc*4, bitslp)
+                        self.bitslips[iadc].append(bitslp)
         print('Failed', file=sys.stderr)
         return False
 
 
     def CalibrateIDelaySingle(self, nadc, chn):
-        self.RegWrite(ADCDEBUGCHAN, nadc*32 + chn*2) 
-        dly_good_first = -1
-        dly_good_last = -1
-        for dly in range(0,0x20) :
-            self.RegWrite(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, dly)
-            res = self.CheckPattern(nadc, self.TestPattern[0]) 
-            # res2 = self.CheckPattern(nadc, self.TestPattern[1]) 
-            
-            if res : 
-                if dly_good_first == -1 : dly_good_first = dly
-                dly_good_last = dly
-        if dly_good_first != -1 :
-            dly_best = int((dly_good_first+dly_good_last)/2)
-            print("Channel %d : dly_good_first = %d dly_good_last = %d best = %d" 
-                % (chn, dly_good_first, dly_good_last, dly_best), file=sys.stderr)
-            self.RegWrite(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, dly_best)
-            return True
-        else:
-            print('No delay found for channel %d' % (chn), file=sys.stderr)
-            return False
+        return self.CalibrateIDelayLanes([(nadc, chn)])[(nadc, chn)]
+
+    # calibrate the data IDELAYs of several lanes, (nadc, chn) pairs, at once.
+    # the eye searches of all the lanes run side by side, so probes from
+    # different lanes (and ADCs) share transactions where they fit, see ProbeLanes()
+    # returns {lane : True if an eye was found}
+    def CalibrateIDelayLanes(self, lanes):
+        ntrans = self.ntrans
+        for nadc in sorted(set([lane[0] for lane in lanes])) :
+            self.AdcSetTestPat(nadc, self.TestPattern[0])
+
+        searches = {}
+        probes = {}
+        for lane in lanes :
+            searches[lane] = self.EyeSearch()
+            probes[lane] = 0
+        def probe(taps) :
+            for lane in taps : probes[lane] += 1
+            return self.ProbeLanes(taps, self.TestPattern[0])
+            # res2 = self.ProbeLanes(taps, self.TestPattern[1])
+        eyes = self.RunEyeSearches(searches, probe)
+
+        ret = {}
+        for lane in lanes :
+            nadc, chn = lane
+            eye = eyes[lane]
+            if eye is not None :
+                dly_good_first, dly_good_last = eye
+                dly_best = int((dly_good_first+dly_good_last)/2)
+                print("ADC %d channel %d : dly_good_first = %d dly_good_last = %d best = %d (%d probes)" 
+                    % (nadc, chn, dly_good_first, dly_good_last, dly_best, probes[lane]), file=sys.stderr)
+                self.brd.poke(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, dly_best)
+                self.data_dly[lane] = dly_best
+                ret[lane] = True
+            else:
+                print('No delay found for ADC %d channel %d (%d probes)' % (nadc, chn, probes[lane]), file=sys.stderr)
+                ret[lane] = False
+
+        # the best delays go out together
+        if any(ret.values()) :
+            self.Transact()
+        print("%d lanes calibrated in %d transactions" % (len(lanes), self.ntrans - ntrans), file=sys.stderr)
+        return ret
+
+    # check the test pattern (already set) on each lane in taps, {lane : dly},
+    # with its data delay at that tap.  each check switches the debug mux to its lane,
+    # writes the delay and reads the pattern back NCalSamples times.  the mux and
+    # delay stay put between transactions, so the checks run back to back and are
+    # cut into transactions of BATCHSIZE wherever they fall (a lane's reads can
+    # straddle two transactions, and several lanes share one).
+    # returns {lane : True if the pattern was good}
+    def ProbeLanes(self, taps, pattern):
+        lanes = list(taps.keys())
+        vals = []
+        queued = 0
+        for nadc, chn in lanes :
+            if queued + 2 > BATCHSIZE :
+                vals += self.Transact(ADCDEBUG1)
+                queued = 0
+            self.brd.poke(ADCDEBUGCHAN, nadc*32 + chn*2)
+            self.brd.poke(ADCDATADELAY_0 + 16*nadc*4 + 4*chn, taps[(nadc, chn)])
+            queued += 2
+            for i in range(0,self.NCalSamples) :
+                if queued == BATCHSIZE :
+                    vals += self.Transact(ADCDEBUG1)
+                    queued = 0
+                self.brd.peek(ADCDEBUG1)
+                queued += 1
+        if queued :
+            vals += self.Transact(ADCDEBUG1)
+        vals = np.array(vals).reshape(len(lanes), self.NCalSamples)
+        res = {}
+        for lane, good in zip(lanes, np.all(vals == pattern, axis=1)) :
+            res[lane] = bool(good)
+        return res
 
     def CalibrateIDelayFrame(self, nadc):
-        dly_good_first = -1
-        dly_good_last  = -1
-        dly_seqs = []
-        i = 0
-        dly_prev_bad = False
-        for dly in range(0,0x20) :
-            self.RegWrite(ADCFRAMEDELAY_0+nadc*4, dly)
-            time.sleep(0.01)
-            sta = self.RegRead(STATUS) & (1 << nadc)
-            if sta != 0 :
-                if dly_prev_bad : i = i + 1
-                if len(dly_seqs) < i+1 :
-                    dly_seqs.append([])
-                dly_seqs[i].append(dly)
-                dly_prev_bad = False
-            else :
-                if len(dly_seqs) != 0 : dly_prev_bad = True
-        print(dly_seqs, file=sys.stderr)
-        if len(dly_seqs) != 0:
-            dly_lens = [len(s) for s in dly_seqs]
-            imax = dly_lens.index(max(dly_lens))
-            print(imax, file=sys.stderr)
-            dly_best = (dly_seqs[imax][0] + dly_seqs[imax][-1])/2
+        return self.CalibrateIDelayFrames([nadc])[nadc]
+
+    # calibrate the frame IDELAYs of several ADCs at once.
+    # returns {nadc : best delay}
+    def CalibrateIDelayFrames(self, nadcs):
+        ntrans = self.ntrans
+        searches = {}
+        for nadc in nadcs :
+            searches[nadc] = self.EyeSearch()
+        eyes = self.RunEyeSearches(searches, self.ProbeFrames)
+
+        frame_dly = {}
+        for nadc in nadcs :
+            eye = eyes[nadc]
+            if eye is None :
+                raise Exception('No delay found for frame signal for ADC#%d'%(nadc))
+            dly_best = (eye[0] + eye[1])/2
             print("ADC %d frame delay : dly_good_first = %d dly_good_last = %d best = %d" 
-                 % (nadc, dly_seqs[imax][0], dly_seqs[imax][-1], dly_best), file=sys.stderr)
-            return int(dly_best)
+                 % (nadc, eye[0], eye[1], dly_best), file=sys.stderr)
+            frame_dly[nadc] = int(dly_best)
+        print("frame delays found in %d transactions" % (self.ntrans - ntrans), file=sys.stderr)
+        return frame_dly
+
+    # set the frame delays in taps, {nadc : dly}, let them settle, and check
+    # frame lock.  each ADC has its own delay register and STATUS bit, so one
+    # settle and one STATUS read serve them all.
+    # returns {nadc : True if locked}
+    def ProbeFrames(self, taps):
+        for nadc, dly in taps.items() :
+            self.brd.poke(ADCFRAMEDELAY_0+nadc*4, dly)
+        self.Transact()
+        time.sleep(0.01)
+        sta = self.RegRead(STATUS)
+        res = {}
+        for nadc in taps :
+            res[nadc] = sta & (1 << nadc) != 0
+        return res
+
+    # run several eye searches side by side.
+    # searches is {key : EyeSearch()}, and probe(taps) is handed {key : dly}
+    # for every search that wants a tap checked, returning {key : good}.
+    # returns {key : (first, last) or None}
+    def RunEyeSearches(self, searches, probe):
+        eyes = {}
+        taps = {}
+        for key, search in searches.items() :
+            taps[key] = next(search)
+        while len(taps) != 0 :
+            res = probe(taps)
+            pending = {}
+            for key in taps :
+                try :
+                    pending[key] = searches[key].send(res[key])
+                except StopIteration as done :
+                    eyes[key] = done.value
+            taps = pending
+        return eyes
+
+    # the search for one eye, as a generator: it yields the taps it wants
+    # checked and is sent back whether each was good.
+    # every coarse-th tap is probed first, then the edges of each good stretch
+    # are refined by bisecting towards the neighbouring bad taps, and every tap
+    # in between is checked too (a bad tap can hide between coarse ones).
+    # if the widest eye found is narrower than coarse, a wider one could have
+    # been missed entirely, so then every tap is tried.
+    # returns (first, last) good taps of the widest stretch, or None
+    def EyeSearch(self, ntaps = 0x20, coarse = 4):
+        seen = {}
+
+        # stretches of consecutive good taps (consecutive in taps, that is)
+        def runs(taps) :
+            found = []
+            start = -1
+            for i, dly in enumerate(taps) :
+                if seen[dly] and start == -1 : start = i
+                if not seen[dly] and start != -1 :
+                    found.append((taps[start], taps[i - 1]))
+                    start = -1
+            if start != -1 : found.append((taps[start], taps[-1]))
+            return found
+
+        # keep the widest (first one wins ties)
+        def widest(found, best) :
+            for first, last in found :
+                if best is None or last - first > best[1] - best[0] : best = (first, last)
+            return best
+
+        taps = list(range(0, ntaps, coarse))
+        for dly in taps :
+            seen[dly] = yield dly
+
+        best = None
+        for first, last in runs(taps) :
+            # bisect the edges (taps off either end count as bad)
+            lo = max(first - coarse, -1)
+            while first - lo > 1 :
+                mid = (lo + first) // 2
+                if mid not in seen : seen[mid] = yield mid
+                if seen[mid] : first = mid
+                else : lo = mid
+            hi = min(last + coarse, ntaps)
+            while hi - last > 1 :
+                mid = (last + hi) // 2
+                if mid not in seen : seen[mid] = yield mid
+                if seen[mid] : last = mid
+                else : hi = mid
+
+            # then check everything inside
+            for dly in range(first, last + 1) :
+                if dly not in seen : seen[dly] = yield dly
+            best = widest(runs(list(range(first, last + 1))), best)
+
+        if best is None or best[1] - best[0] + 1 < coarse :
+            for dly in range(0, ntaps) :
+                if dly not in seen : seen[dly] = yield dly
+            best = widest(runs(list(range(0, ntaps))), None)
+        return best
 
-        else:
-            raise Exception('No delay found for frame signal for ADC#%d'%(nadc))
-        
+    #####################################################
+    # IDELAY calibration cache
+    #####################################################
+    # calibrations are kept per board, keyed by device DNA, in <dna>.idelay
+    # they are only good for the firmware version they were taken with
+    def IDelayCache(self) :
+        dna_l, dna_h, fw = self.RegReadMany([DEVICEDNA_L, DEVICEDNA_H, FW_VERSION])
+        return ("%016x.idelay" % ((int(dna_h) << 32) | int(dna_l)), int(fw))
+
+    def SaveIDelays(self) :
+        fname, fw = self.IDelayCache()
+        cache = {
+            'fw_version' : fw,
+            'frame'      : dict(self.frame_dly),
+            'data'       : dict(self.data_dly),
+            'bitslip'    : dict(self.bitslips)
+        }
+        pickle.dump(cache, open(fname, "wb"))
+        print("IDELAY calibration saved to %s" % (fname), file=sys.stderr)
+
+    # put back the cached delays and bitslips for this board, and check
+    # that they still give frame lock and clean test patterns on every lane.
+    # returns False (with the bitslips reset) if a full calibration is needed
+    def RestoreIDelays(self) :
+        ntrans = self.ntrans
+        fname, fw = self.IDelayCache()
+        try :
+            cache = pickle.load(open(fname, "rb"))
+        except (OSError, EOFError, pickle.UnpicklingError) :
+            print("No IDELAY calibration cached in %s" % (fname), file=sys.stderr)
+            return False
+
+        if cache['fw_version'] != fw :
+            print("IDELAY calibration in %s is for FW %s, not %s" % (fname, hex(cache['fw_version']), hex(fw)), file=sys.stderr)
+            return False
 
-    def CheckPattern(self, nadc, pattern):
-        self.AdcSetTestPat(nadc, pattern)
-        for i in range(0,self.NCalSamples) :
-            val = self.RegRead(ADCDEBUG1)
-            if val != pattern :
+        # frame delays first, then clear the data line bitslips
+        # (just as CalibrateIDelaysFrameAll() leaves things)
+        if len(cache['frame']) != 0 :
+            locked = self.ProbeFrames(cache['frame'])
+            self.RegSetBit(CMD, C_CMD_RESET_BIT, 1)
+            if not all(locked.values()) :
+                print("Cached frame delays no longer lock: %s" % (locked), file=sys.stderr)
                 return False
+
+        # replay the bitslips, in the order they were needed
+        for nadc, masks in cache['bitslip'].items() :
+            for mask in masks :
+                self.RegWrite(BITSLIP+nadc*4, mask)
+
+        # check the test pattern on every lane at its cached delay
+        # (which also writes the delays)
+        nadcs = sorted(set([lane[0] for lane in cache['data']]))
+        for nadc in nadcs :
+            self.AdcSetTestMode(nadc, 'custom')
+            self.AdcSetTestPat(nadc, self.TestPattern[0])
+        res = self.ProbeLanes(cache['data'], self.TestPattern[0])
+        for nadc in nadcs :
+            self.AdcSetTestMode(nadc, 'normal')
+
+        bad = [lane for lane in cache['data'] if not res[lane]]
+        if len(bad) != 0 :
+            print("Cached data delays failed verification on lanes %s" % (bad), file=sys.stderr)
+            # undo the replayed bitslips
+            self.RegSetBit(CMD, C_CMD_RESET_BIT, 1)
+            return False
+
+        self.frame_dly = cache['frame']
+        self.data_dly = cache['data']
+        self.bitslips = cache['bitslip']
+        print("IDELAY calibration restored from %s in %d transactions" % (fname, self.ntrans - ntrans), file=sys.stderr)
         return True
 
     #####################################################
@@ -379,35 +633,30 @@ class lappdInterface :
         self.RegSetBit(MODE,C_MODE_ADCBUF_WREN_BIT,0)
             
     def ReadMem(self, start_addr, num_words, chan = -1, fname = "") :
-        ret_val = []
         self.AdcBufStop();
         
         if chan != -1 :
             if not self.SetDebugChan(chan) : return -1
 
-        if fname != "" : filo = open(fname,"w+")
-
         addr = 0x3000 + (1<<2)
         v = self.RegRead(addr)
-        
-        for i in range(0,num_words):
-            # FIXME use multiple peek followed by transfer
-            # addr = 0x3000 + ((start_addr + i)<<2)
-            addr = 0x3000 
-            v = self.RegRead(addr)
-            # convert two's compliment to signed int
-            if v & (1<<11) != 0 : v = v - 0xfff
-            ret_val.append(v)
-            if fname != "" : filo.write("%d %d\n" % (i, v))
+
+        # the buffer is read out word by word through 0x3000
+        # addr = 0x3000 + ((start_addr + i)<<2)
+        ret_val = self.RegReadMany([0x3000]*num_words)
+
+        # convert two's compliment to signed int
+        ret_val = np.where(ret_val & (1<<11) != 0, ret_val - 0xfff, ret_val)
+
+        if fname != "" :
+            with open(fname,"w+") as filo :
+                np.savetxt(filo, np.column_stack((np.arange(num_words), ret_val)), fmt="%d %d")
         #self.AdcBufStart()
         return ret_val 
 
     def ReadWf(self) :
         raw = self.ReadMem(0, 4200, 15)
-        wf  = [0]*1024
-        for isa in range(0,1024):
-            wf[isa] = raw[self.AdcSampleOffset + 4*isa] - int(self.peds[isa])
-        return wf
+        return raw[self.AdcSampleOffset:self.AdcSampleOffset + 4*1024:4] - np.trunc(self.peds).astype(np.int64)
     #####################################################
     # DAC configuration
     #####################################################
@@ -491,7 +740,8 @@ class lappdInterface :
         self.RegSetBit(MODE, C_MODE_DRS_DENABLE_BIT,1)
         self.RegSetBit(MODE, C_MODE_DRS_TRANS_BIT,1)
 
-        bufs = [[0]*5 for i in range(1024)]
+        # (samples x events)
+        bufs = np.zeros((1024, nev), dtype=np.int64)
 
         for i in range(nev) :
             print(i, file=sys.stderr)
@@ -499,24 +749,21 @@ class lappdInterface :
             time.sleep(0.001)
             v = self.ReadMem(0,4200,15)
             # print(v)
-            for isample in range(0,1024) :
-                bufs[isample][i] = v[self.AdcSampleOffset + 4*isample]
+            bufs[:, i] = v[self.AdcSampleOffset:self.AdcSampleOffset + 4*1024:4]
         
         print(bufs, file=sys.stderr)
 
-        for isa in range(0,1024):
-            buf = bufs[isa]
-            mean = np.around(np.mean(buf),1)
-            bufx = [(a - mean) for a in bufs[isa]]
-            rms = np.around(np.sqrt(np.mean(np.square(bufx))),1)
-            self.peds[isa] = mean
-            self.rmss[isa] = rms
+        mean = np.around(np.mean(bufs, axis=1),1)
+        rms = np.around(np.sqrt(np.mean(np.square(bufs - mean[:, None]), axis=1)),1)
+        self.peds = mean
+        self.rmss = rms
         #print(self.peds)
         print(self.rmss, file=sys.stderr)
         return 
 
 
-    def Initialize(self, doCal = True):
+    # recalibrate ignores any cached IDELAY calibration for this board
+    def Initialize(self, doCal = True, recalibrate = False):
         fwver = self.RegRead(FW_VERSION) & 0xff
         
         print('FW version : %d' % (fwver), file=sys.stderr)
@@ -534,8 +781,11 @@ class lappdInterface :
         self.DacSetAll()
 
 
-        if fwver >= 100 and doCal : self.CalibrateIDelaysFrameAll()
-        if doCal : self.CalibrateIDelaysDataAll()
+        # use the cached IDELAYs for this board, if they still work
+        if doCal and (recalibrate or not self.RestoreIDelays()) :
+            if fwver >= 100 : self.CalibrateIDelaysFrameAll()
+            self.CalibrateIDelaysDataAll()
+            self.SaveIDelays()
 
         # self.RegWrite(DRSREFCLKRATIO, self.drsrefclk)
         # print("DRSREFCLKRATIO : %d" % (self.drsrefclk), file=sys.stderr)
@@ -3,6 +3,7 @@
 # We use bitstruct since it automates working at the bit level
 # This package defaults to MSB and MSb, which is what we like to use in FPGA
 import bitstruct
+import struct
 import sys
 import socket
 import random
@@ -11,6 +12,9 @@ import pickle
 import queue
 import time
 import collections
+import multiprocessing
+import atexit
+from multiprocessing import shared_memory
 from os import getpid
 
 # Define the format of a hit packet
@@ -21,6 +25,9 @@ from os import getpid
 #  HIT_PAYLOAD_SIZE (16 bits, representing byte length of all seq packet payloads WITHIN THIS HIT) (1.5 bytes)
 #  TRIGGER_TIMESTAMP_L (32 bits) (4 bytes)
 # ------------------------------------ (bitstruct for the above fixed header, 11 bytes)
+#
+# (As currently sent by the firmware, DRS4_OFFSET is a full 16 bits and SEQ a full byte,
+#  so the fixed header is 12 bytes.)
 #  PAYLOAD (arbitrary, but less than an Ethernet MTU for sure)
 #  HIT_FOOTER_MAGIC (16 bits)
 hit_fmt = "u16 u8 u16 u8 u16 u32"
@@ -45,10 +52,180 @@ event_fmt = "u16 r48 p8 u3 p5 u16 u16 u8 p8 u32 u32 p64"
 eventpacker = bitstruct.compile(event_fmt, ["magic", "board_id", "adc_bit_width", "evt_number", "evt_size", "num_hits", "trigger_timestamp_h", "trigger_timestamp_l"])
 globals()['EVT_MAGIC'] = 0x39ab
 
-# Hack to do things fast(er)?
-# yeah, way better
-import struct
-doit = struct.Struct(">512h")
+#
+# Fast header parsing
+#
+# Header parsing happens for every datagram, and bitstruct builds a dict
+# through its generic bit-level machinery each time.  Every field of both
+# headers falls on a byte boundary (the 3-bit ADC width is the top of its
+# own byte), so a precompiled struct does the same job with a single call.
+#
+# bitstruct remains the reference: it is used to generate packets, and
+# verifyHeaders() checks that the two agree.
+#
+class hitheader:
+
+    __slots__ = ['magic', 'channel_id', 'drs4_offset', 'seq', 'hit_payload_size', 'trigger_timestamp_l', 'payload', 'max_samples', 'slot', 'addr']
+    layout = struct.Struct(">HBHBHI")
+
+    def __init__(self, data):
+        (self.magic,
+         self.channel_id,
+         self.drs4_offset,
+         self.seq,
+         self.hit_payload_size,
+         self.trigger_timestamp_l) = hitheader.layout.unpack_from(data)
+
+        # Filled in by whoever received the packet
+        self.payload = None
+        self.max_samples = None
+        self.slot = None
+        self.addr = None
+
+    def __repr__(self):
+        return repr({field : getattr(self, field) for field in hitheader.__slots__})
+
+class eventheader:
+
+    __slots__ = ['magic', 'board_id', 'adc_bit_width', 'evt_number', 'evt_size', 'num_hits', 'trigger_timestamp_h', 'trigger_timestamp_l']
+    layout = struct.Struct(">H6sxBHHBxII8x")
+
+    def __init__(self, data):
+        (self.magic,
+         self.board_id,
+         self.adc_bit_width,
+         self.evt_number,
+         self.evt_size,
+         self.num_hits,
+         self.trigger_timestamp_h,
+         self.trigger_timestamp_l) = eventheader.layout.unpack_from(data)
+
+        # Only the top 3 bits of the type byte are the width
+        self.adc_bit_width >>= 5
+
+    def __repr__(self):
+        return repr({field : getattr(self, field) for field in eventheader.__slots__})
+
+#
+# Check the struct parsers against the bitstruct packers over random headers.
+# Raises if they ever disagree.
+#
+#  python3 -c "import lappdProtocol; lappdProtocol.verifyHeaders()"
+#
+def verifyHeaders(trials=10000):
+
+    for n in range(trials):
+        fields = {
+            'magic' : random.getrandbits(16),
+            'channel_id' : random.getrandbits(8),
+            'drs4_offset' : random.getrandbits(16),
+            'seq' : random.getrandbits(8),
+            'hit_payload_size' : random.getrandbits(16),
+            'trigger_timestamp_l' : random.getrandbits(32)
+        }
+        parsed = hitheader(hitpacker.pack(fields))
+        for field, value in fields.items():
+            if not getattr(parsed, field) == value:
+                raise Exception("Hit header field %s parsed as %d, packed as %d" % (field, getattr(parsed, field), value))
+
+        fields = {
+            'magic' : random.getrandbits(16),
+            'board_id' : bytes(random.getrandbits(8) for i in range(6)),
+            'adc_bit_width' : random.getrandbits(3),
+            'evt_number' : random.getrandbits(16),
+            'evt_size' : random.getrandbits(16),
+            'num_hits' : random.getrandbits(8),
+            'trigger_timestamp_h' : random.getrandbits(32),
+            'trigger_timestamp_l' : random.getrandbits(32)
+        }
+
+        # Padding is ignored by both, so fill it with junk
+        raw = bytearray(eventpacker.pack(fields))
+        raw[8] = random.getrandbits(8)
+        raw[9] |= random.getrandbits(5)
+        raw[15] = random.getrandbits(8)
+        raw[24:] = bytes(random.getrandbits(8) for i in range(8))
+
+        parsed = eventheader(raw)
+        for field, value in eventpacker.unpack(raw).items():
+            if not getattr(parsed, field) == value:
+                raise Exception("Event header field %s parsed as %s, packed as %s" % (field, getattr(parsed, field), value))
+
+    print("Header parsers agree with bitstruct over %d random headers" % trials, file=sys.stderr)
+
+# Payload decoding is done with NumPy views directly onto the received bytes
+import numpy as np
+
+#
+# Decoder registry
+#
+# Keyed by (resolution, payload length in bytes), each entry is a callable
+# taking a payload (bytes, bytearray, or memoryview) and returning a NumPy
+# view of the samples it contains.  No per-sample Python objects are made.
+#
+# Byte-aligned resolutions are big-endian, signed (as sent by the FPGA)
+# Sub-byte resolutions expand through a 256-entry lookup table
+#
+decoders = {}
+sample_dtypes = {
+    3 : np.dtype('>i1'),
+    4 : np.dtype('>i2'),
+    5 : np.dtype('>i4'),
+    6 : np.dtype('>i8')
+}
+
+#
+# Bit packers and lookup tables for sub-byte resolutions (1, 2, and 4-bit signed samples)
+# These are compiled once per process and shared by all events
+#
+packers = {}
+lookups = {}
+
+def getPacker(resolution):
+
+    if not resolution in packers:
+        packers[resolution] = bitstruct.compile(" ".join(["s%d" % (1 << resolution)] * (8 >> resolution)))
+
+    return packers[resolution]
+
+def getLookup(resolution):
+
+    if not resolution in lookups:
+
+        # Row b holds the samples packed into the byte b, MSb first.
+        # Use the bit packer to build it, so the table agrees with generation
+        unpacker = getPacker(resolution)
+        lookups[resolution] = np.array([unpacker.unpack(bytes([b])) for b in range(256)], dtype=np.int8)
+
+    return lookups[resolution]
+
+def getDecoder(resolution, length):
+
+    key = (resolution, length)
+    try:
+        return decoders[key]
+    except KeyError:
+        pass
+
+    # Sub-byte samples: a single fancy index expands the whole payload
+    if resolution < 3:
+        table = getLookup(resolution)
+        decoders[key] = lambda payload : table[np.frombuffer(payload, dtype=np.uint8, count=length)].reshape(-1)
+        return decoders[key]
+
+    if not resolution in sample_dtypes:
+        raise Exception("No decoder available for resolution %d" % resolution)
+
+    dtype = sample_dtypes[resolution]
+
+    # Sanity check (partial samples mean a broken fragment)
+    count, remainder = divmod(length, dtype.itemsize)
+    if remainder:
+        raise Exception("Payload of %d bytes is not a whole number of %d-bit samples" % (length, 1 << resolution))
+
+    # Make it, and remember it
+    decoders[key] = lambda payload : np.frombuffer(payload, dtype=dtype, count=count)
+    return decoders[key]
 
 #
 # Set a maximum payload size in bytes
@@ -58,6 +235,10 @@ doit = struct.Struct(">512h")
 # Force fragmentation (for generation only)
 globals()['LAPPD_MTU'] = 90
 
+# Number of preallocated receive buffers in each intake process
+# (this many fragments can be held by incomplete events and orphans before the pool grows)
+globals()['LAPPD_POOL_SLOTS'] = 4096
+
 class timing(object):
 
     #
@@ -65,8 +246,6 @@ class timing(object):
     #
     def __init__(self, chanmap, dts, reference, deltat_chip):
 
-        from numpy import cumsum
-        
         #
         # lambda chan : an anonymous function that returns the calibration channel associated with the regular channel "chan"
         #
@@ -88,55 +267,90 @@ class timing(object):
 
         # By definition, the 
         self.deltat_chip[self.reference] = 0.0
- 
-        # Right and left offsets are computed relative to the stop sample
+
+        # DELIVERABLE
+        self.build()
+
+    #
+    # Compute the time of every capacitor, relative to the stop sample.
+    #
+    # The time of capacitor i only depends on which side of the stop it is:
+    #
+    #   left[i]  = deltat_chip + sum(dts[:i])            (i < stop)
+    #   right[i] = deltat_chip - sum(dts[-(1024-i):])    (i >= stop)
+    #
+    # so the full (stop x capacitor) timing map is never materialized.
+    # Only the differentials are saved, and this is rebuilt on load.
+    #
+    def build(self):
+
+        # Right and left offsets are computed relative to the stop sample.
+        # They are stacked, one row per calibration channel, so that a whole
+        # event can be gathered at once.
+        self.rows = {chan : row for row, chan in enumerate(self.chans)}
+        self.left = np.empty((len(self.chans), 1024), dtype=np.float64)
+        self.right = np.empty((len(self.chans), 1024), dtype=np.float64)
         self.left_offsets = {}
         self.right_offsets = {}
 
-        # DELIVERABLE
-        # Timing maps for direct lookup
-        self.timemap = {}
+        caps = np.arange(1024)
+        for row, chan in enumerate(self.chans):
 
-        for chan in self.chans:
-            self.left_offsets[chan] = []
-            self.right_offsets[chan] = []
+            dts = np.asarray(self.dts[chan], dtype=np.float64)
 
-            # Iterate over possible stop samples
-            for i in range(1024):
+            # Sums of the first k, and of the last k, differentials
+            # (clipped, as slicing would)
+            prefix = np.concatenate(([0.0], np.cumsum(dts)))
+            suffix = np.concatenate(([0.0], np.cumsum(dts[::-1])))
 
-                # Things to the left of stop accumulate time up until stop
-                self.left_offsets[chan].append(deltat_chip[chan] + sum(dts[chan][:i]))
+            # Things to the left of stop accumulate time up until stop
+            self.left[row] = self.deltat_chip[chan] + prefix[np.minimum(caps, len(dts))]
+            self.left_offsets[chan] = self.left[row]
 
-                # Things to the right of stop accumulate negative time heading toward stop
-                # NOTE: thing[-0:] = entire list
-                self.right_offsets[chan].append(deltat_chip[chan] - sum(dts[chan][-(1024-i):]))
+            # Things to the right of stop accumulate negative time heading toward stop
+            # NOTE: thing[-0:] = entire list
+            self.right[row] = self.deltat_chip[chan] - suffix[np.minimum(1024 - caps, len(dts))]
+            self.right_offsets[chan] = self.right[row]
 
-        # And all possible shifts, which depend
-        # on where you stop
+        # The capacitor holding the earliest time over all channels and stops
+        # (only ever found when stopped at 0, since every capacitor is then to the right)
         self.shift = [0]*1024
 
         mintime = 0.0
         for chan in self.chans:
+            earliest = int(np.argmin(self.right_offsets[chan]))
+            if self.right_offsets[chan][earliest] < mintime:
+                mintime = self.right_offsets[chan][earliest]
+                self.shift[0] = earliest
+
+    #
+    # Timing files only carry the differentials
+    #
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for derived in ('rows', 'left', 'right', 'left_offsets', 'right_offsets', 'shift'):
+            state.pop(derived, None)
+        return state
 
-            # Now make all possible timing maps
-            self.timemap[chan] = {}
+    def __setstate__(self, state):
+
+        # Timing files written before build() existed carry the full map
+        state.pop('timemap', None)
+        state.pop('shift', None)
+
+        self.__dict__.update(state)
+        self.build()
+
+    #
+    # The absolute time of every capacitor on a calibration channel, for the given stop
+    #
+    def times(self, calibration_channel, stop):
+
+        times = np.empty(1024, dtype=np.float64)
+        times[:stop] = self.left_offsets[calibration_channel][:stop]
+        times[stop:] = self.right_offsets[calibration_channel][stop:]
+        return times
 
-            for stop in range(1024):
-                self.timemap[chan][stop] = [0]*1024
-                
-                for i in range(stop):
-                    self.timemap[chan][stop][i] = self.left_offsets[chan][i]
-
-                for i in range(stop, 1024):
-                    self.timemap[chan][stop][i] = self.right_offsets[chan][i]
-                    if self.timemap[chan][stop][i] < mintime:
-                        mintime = self.timemap[chan][stop][i]
-                        self.shift[stop] = i
-
-        # Cleanup
-        del(self.left_offsets)
-        del(self.right_offsets)
-            
     #
     # Return a dictionary mapping capacitor positions to absolute times
     #
@@ -144,43 +358,37 @@ class timing(object):
 
         timemap = {}
 
-        chans = event.channels.keys()
-        mintime = 0.0
-        self.shift = 0
-        
-        for chan in chans:
-
-            stop_sample = event.offsets[chan]
-            timemap[chan] = [0]*1024
+        for chan, stop in zip(event.chan_ids.tolist(), event.stops.tolist()):
 
             # Get the calibration channel appropriate for this actual channel
-            calibration_channel = self.chanmap[chan]
-                        
-            for i in range(stop_sample):
-                timemap[chan][i] = self.left_offsets[calibration_channel][i]
-
-            for i in range(stop_sample, 1024):
-                timemap[chan][i] = self.right_offsets[calibration_channel][i]
-                if timemap[chan][i] < mintime:
-                    mintime = timemap[chan][i]
-                    self.shift = i
+            timemap[chan] = self.times(self.chanmap[chan], stop)
 
         return timemap
 
     #
-    # Replace lists of amplitudes with a list of (time, amplitude) tuples 
+    # Give the event a time axis for each channel
+    # (the amplitudes are left alone)
+    #
+    # Every row is gathered from the stacked offsets in one pass:
+    # capacitors before the stop come from the left offsets, the rest from the right.
     #
     def apply(self, event):
 
-        for chan in event.channels.keys():
-            event.channels[chan] = list(zip(self.timemap[self.chanmap[chan]][event.offsets[chan]], event.channels[chan]))
+        # Nothing to time (a partial event without any hits)
+        if not event.amplitudes.size:
+            event.times = np.zeros(event.amplitudes.shape, dtype=np.float64)
+            return
+
+        calibration_rows = [self.rows[self.chanmap[chan]] for chan in event.chan_ids.tolist()]
+        before = np.arange(event.amplitudes.shape[1]) < event.stops[:, None]
+
+        event.times = np.where(before, self.left[calibration_rows], self.right[calibration_rows])
 
     #
     # Discard an existing timing calibration
     #
     def remove(self, event):
-        for chan in event.channels.keys():
-            event.channels[chan] = list(list(zip(*event.channels[chan]))[0])
+        event.times = None
     
     #
     # "Barrel shift" the event so that the stop sample is the first sample
@@ -188,114 +396,189 @@ class timing(object):
     #
     def timeorder(self, event):
 
-        for chan in event.channels.keys():
+        if not event.amplitudes.size:
+            return
 
-            # Define the tare (shift left, not right)
-            #tare = 1024 - self.shift[event.offsets[chan]]
-            #tare = self.shift[event.offsets[chan]]
-            tare = event.offsets[chan]
+        # Where each time ordered sample comes from
+        # (shift left, not right)
+        samples = event.amplitudes.shape[1]
+        order = (np.arange(samples) + event.stops[:, None]) % samples
 
-            # HACKY because, in principle, the protocol supports different
-            # numbers of channels on each 
-            max_samples = 1024
-            
-            # Since we are not memory limited in 2019, just do an offset copy
-            tmp = [0]*max_samples
+        event.amplitudes = np.take_along_axis(event.amplitudes, order, axis=1)
+        event.masked = np.take_along_axis(event.masked, order, axis=1)
+
+        if not event.times is None:
+            event.times = np.take_along_axis(event.times, order, axis=1)
+
+#
+# Streaming per-capacitor statistics (Welford's algorithm).
+#
+# Events are folded in as they arrive, so building a pedestal from any
+# number of events takes the same (small) amount of memory: a count,
+# mean, and sum of squared deviations (M2) for every capacitor.
+# Masked (NaN) samples are skipped.
+#
+class accumulator(object):
+
+    def __init__(self):
+
+        # Fixed by the first event
+        self.board_id = None
+        self.chan_ids = None
+
+        # (channels x capacitors)
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+        # How many events went in
+        self.events = 0
+
+    def add(self, anevent):
+
+        if not anevent.keep_offset:
+            raise Exception("Refusing to build pedestals with torn data (ROI mode)")
+
+        if self.chan_ids is None:
+            self.board_id = anevent.board_id
+            self.chan_ids = anevent.chan_ids.copy()
+
+            shape = anevent.amplitudes.shape
+            self.count = np.zeros(shape, dtype=np.int64)
+            self.mean = np.zeros(shape, dtype=np.float64)
+            self.m2 = np.zeros(shape, dtype=np.float64)
+
+        elif not np.array_equal(self.chan_ids, anevent.chan_ids) or not self.mean.shape == anevent.amplitudes.shape:
+            raise Exception("Provided sample events for pedestaling have inhomogeneous channel content.  This .... is ... U N A C C E P T A B L E E E E ---- U N A C C E P T A B L E E E E E E E")
+
+        valid = ~anevent.masked
+        x = np.where(valid, anevent.amplitudes, 0.0)
+
+        self.count += valid
+        delta = np.where(valid, x - self.mean, 0.0)
+        self.mean += delta/np.maximum(self.count, 1)
+        self.m2 += delta*(x - self.mean)
+
+        self.events += 1
+
+    #
+    # Fold in the statistics of another accumulator
+    # (the parallel form of the algorithm, Chan et al.)
+    #
+    def merge(self, other):
+
+        if other.chan_ids is None:
+            return
 
-            # Minimize computations
-            delta = max_samples - tare
+        if self.chan_ids is None:
+            self.board_id = other.board_id
+            self.chan_ids = other.chan_ids.copy()
+            self.count = other.count.copy()
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.events = other.events
+            return
 
-            # Do the head of the final list...
-            tmp[:delta] = event.channels[chan][tare:max_samples]
+        if not np.array_equal(self.chan_ids, other.chan_ids) or not self.mean.shape == other.mean.shape:
+            raise Exception("Cannot merge pedestal statistics over different channels")
 
-            # ... and the tail
-            tmp[delta:] = event.channels[chan][0:tare]
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        weight = np.maximum(count, 1)
 
-            # Replace amplitudes
-            event.channels[chan] = tmp
+        self.mean += delta*other.count/weight
+        self.m2 += other.m2 + delta*delta*self.count*other.count/weight
+        self.count = count
+        self.events += other.events
+
+    #
+    # Per channel lists of (integer) means and variances, as pedestals keep them.
+    # Capacitors without samples get None, as does the variance of a single sample.
+    #
+    def moments(self):
+
+        means = {}
+        variances = {}
+
+        for row, chan in enumerate(self.chan_ids.tolist()):
+
+            count = self.count[row].tolist()
+
+            #
+            # Note that we save the mean as an integer.
+            # This lets us do integer subtraction without conversion when removing pedestals
+            # directly from the data as it comes in.
+            #
+            # Since noise is a least 30 ADC counts, this changes nothing.
+            #
+            means[chan] = [None if n == 0 else round(mean) for n, mean in zip(count, self.mean[row].tolist())]
+            variances[chan] = [None if n < 2 else m2/(n - 1) for n, m2 in zip(count, self.m2[row].tolist())]
+
+        return means, variances
 
 #
 # Utility class to compute pedestals from a list of events
+# (or from an accumulator that has already seen them)
 #
 class pedestal(object):
 
     def __init__(self, samples):
 
-        # Now compute the pedestals
-        from scipy.stats import describe
-        from numpy import floor
-        
+        if not isinstance(samples, accumulator):
+            events = samples
+            samples = accumulator()
+            for sample in events:
+                if not isinstance(sample, event):
+                    raise Exception("Encountered non-event in list of samples.  Nonsense.")
+                samples.add(sample)
+
         # Did we receive any samples?
-        if not len(samples):
+        if not samples.events:
             raise Exception("Did not receive any samples!")
 
         # Some board information
-        self.board_id = samples[0].board_id
-
-        # Use the first event to determine the list of channels
-        self.chan_list = samples[0].channels.keys()
+        self.board_id = samples.board_id
 
-        # Sanity checks on the pedestal samples
-        for sample in samples:
+        # Set up for pedestals
+        self.mean, self.variance = samples.moments()
 
-            if not isinstance(sample, event):
-                raise Exception("Encountered non-event in list of samples.  Nonsense.")
+    #
+    # The means of a channel as a float array, with NaN where there were no samples.
+    # Built on first use and kept (but not pickled).
+    #
+    def row(self, chan_id):
 
-            if not self.chan_list == sample.channels.keys():
-                raise Exception("Provided sample events for pedestaling have inhomogeneous channel content.  This .... is ... U N A C C E P T A B L E E E E ---- U N A C C E P T A B L E E E E E E E")
-            if not sample.keep_offset:
-                raise Exception("Refusing to build pedestals with torn data (ROI mode)")
+        # Pedestal files written before this existed won't have it
+        rows = self.__dict__.setdefault('rows', {})
 
-        # Set up for pedestals
-        self.mean = {}
-        self.variance = {}
-
-        # Gotta do it manually
-        for chan_id in self.chan_list:
-            caps = [ [] for x in range(0, len(samples[0].channels[chan_id])) ]
-            self.mean[chan_id] = []
-            self.variance[chan_id] = []
-
-            for evt in samples:
-                for capacitor, ampl in enumerate(evt.channels[chan_id]):
-                    if not ampl is None:
-                        caps[capacitor].append(ampl)
-
-            # Now we have it in filtered capacitor form
-            for cap in caps:
-                # Cap is a list
-                N = len(cap)
-                if N == 0:
-                    self.mean[chan_id].append(None)
-                    self.variance[chan_id].append(None)
-                elif N == 1:
-                    self.mean[chan_id].append(cap)
-                    self.variance[chan_id].append(None)
-                else:
-                    bs, bs, mean, variance, *bs = describe(cap)
+        if not chan_id in rows:
+            rows[chan_id] = np.array([np.nan if mean is None else mean for mean in self.mean[chan_id]], dtype=np.float64)
 
-                    #
-                    # Because the numpy method returns some ass-retarded type
-                    #
-                    # Note that we save the mean as an integer.
-                    # This lets us do integer subtraction without conversion when removing pedestals
-                    # directly from the data as it comes in.
-                    #
-                    # Since noise is a least 30 ADC counts, this changes nothing.
-                    #
-                    self.mean[chan_id].append(round(float(mean)))
-                    self.variance[chan_id].append(float(variance))
+        return rows[chan_id]
 
-        # Remove the samples because python can't pickle it
-        del(self.chan_list)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('rows', None)
+        return state
 
     #
-    # Return a pedestal subtracted list of amplitudes
+    # Pedestal subtract a row of amplitudes, in place.
+    #
+    # If the amplitudes have been tared (rotated so that capacitor shift is first),
+    # the means are subtracted through the same rotation.
     #
-    def subtract(self, amplitudes, chan_id):
-        length = len(self.mean[chan_id])
-        for i in range(length):
-            amplitudes[i] -= self.mean[chan_id][i]
+    def subtract(self, amplitudes, chan_id, shift=0):
+        mean = self.row(chan_id)
+
+        if not shift:
+            amplitudes[:len(mean)] -= mean
+            return
+
+        if not len(mean) == len(amplitudes):
+            raise Exception("Pedestal for channel %d has %d capacitors, but the hit has %d" % (chan_id, len(mean), len(amplitudes)))
+
+        amplitudes[:-shift] -= mean[shift:]
+        amplitudes[-shift:] -= mean[:shift]
 
     #
     # Generate a test pedestal, with normally distributed event samples
@@ -330,12 +613,286 @@ class pedestal(object):
         # screwed up
 
         #            print("Pedestal: %d channels, with %d samples each @ %d-bit" % (len(chan_list), numsamples, 1 << resolution), file=sys.stderr)
-        return lappd.event.generateEvent(555, resolution, chan_list, [0]*len(chan_list), ampl_list)
+        return builder.generateEvent(555, resolution, chan_list, [0]*len(chan_list), ampl_list)
+
+
+#
+# A pool of preallocated packet buffers for the receive loop.
+#
+# Datagrams are received directly into free slots with recvfrom_into(),
+# and hit payloads are passed around as memoryviews into those slots.
+# A slot is held until the hit it carries has been translated (or the
+# event holding it is dropped), and is then handed back to the pool.
+# Nothing is copied until the final amplitudes are assembled.
+#
+class packetpool(object):
+
+    def __init__(self, slots, size=1500):
+
+        # Largest datagram we expect (an Ethernet MTU)
+        self.size = size
+
+        # The slots themselves
+        self.buffers = [memoryview(bytearray(size)) for i in range(slots)]
+
+        # Free slots, used as a stack so that recently released
+        # (cache-warm) slots are reused first
+        self.free = list(range(slots))
 
+        # How many times we ran dry and had to allocate
+        self.grown = 0
+
+    #
+    # Get a free slot, as (slot index, memoryview)
+    #
+    def acquire(self):
+
+        # If everything is held by incomplete events and orphans,
+        # grow rather than drop data
+        if not self.free:
+            self.buffers.append(memoryview(bytearray(self.size)))
+            self.free.append(len(self.buffers) - 1)
+            self.grown += 1
+
+        slot = self.free.pop()
+        return (slot, self.buffers[slot])
+
+    #
+    # Return slots to the pool
+    #
+    def release(self, *slots):
+        for slot in slots:
+            if not slot is None:
+                self.free.append(slot)
+
+#
+# Storage for hits that arrive before their event header.
+#
+# Orphans are indexed by their (source address, trigger_timestamp_l) tag,
+# so an arriving event claims exactly its own fragments instead of
+# rescanning every orphan.  The store is bounded both in the number of
+# fragments held and in how long a tag may wait for its event.
+#
+class orphanage(object):
+
+    def __init__(self, limit, max_age, pool=None):
+
+        # Most fragments we will hold before dropping the oldest tags
+        self.limit = limit
+
+        # Longest (seconds) a tag can wait for its event header
+        self.max_age = max_age
+
+        # Where the payloads live, so that dropped fragments give back their slots
+        self.pool = pool
+
+        # tag -> (monotonic time first seen, [fragments])
+        # Insertion ordered, so the oldest tags are always at the front
+        self.orphans = collections.OrderedDict()
+
+        # Bookkeeping
+        self.count = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return self.count
+
+    #
+    # Keep a fragment until its event shows up
+    #
+    def adopt(self, tag, packet):
+
+        if tag in self.orphans:
+            self.orphans[tag][1].append(packet)
+        else:
+            self.orphans[tag] = (time.monotonic(), [packet])
+
+        self.count += 1
+
+        # Over the cap?  Drop whole tags, oldest first.
+        while self.count > self.limit:
+            self.drop()
+
+    #
+    # Hand over (and forget) all fragments waiting for this tag
+    #
+    def claim(self, tag):
+
+        if not tag in self.orphans:
+            return []
+
+        born, fragments = self.orphans.pop(tag)
+        self.count -= len(fragments)
+        return fragments
+
+    #
+    # Drop tags that have waited too long for their event
+    #
+    def expire(self, now=None):
+
+        if now is None:
+            now = time.monotonic()
+
+        while self.orphans:
+            born, fragments = next(iter(self.orphans.values()))
+            if now - born < self.max_age:
+                break
+            self.drop()
+
+    #
+    # Drop the oldest tag
+    #
+    def drop(self):
+
+        tag, (born, fragments) = self.orphans.popitem(last=False)
+        self.count -= len(fragments)
+        self.evicted += len(fragments)
+
+        if self.pool:
+            self.pool.release(*[fragment.slot for fragment in fragments])
+
+#
+# Sample positions to blank out, relative to the stop sample:
+# always the 5 to its right, and the requested number to its left
+# (which includes the stop itself).
+#
+masks = {}
+
+def getMask(mask):
+
+    if not mask in masks:
+        masks[mask] = np.concatenate((np.arange(5), -np.arange(mask)))
+
+    return masks[mask]
+
+#
+# Amplitudes are stored as floats, so that missing and masked samples can be NaN.
+# float32 holds every 16-bit (and smaller) sample exactly.
+#
+def sampleType(resolution):
+    return np.float32 if resolution <= 4 else np.float64
 
 # Define an event class
+#
+# This is a completed event, as shipped to consumers.
+# All channel data lives in a single (channels x samples) array, with
+# NaN where samples are missing or masked.  Row i belongs to channel chan_ids[i].
+#
 class event(object):
 
+    __slots__ = ('evt_number',    # Event number from the header
+                 'board_id',      # Low 48 bits of the device DNA (bytes)
+                 'timestamp',     # 64-bit trigger timestamp from the header
+                 'resolution',    # 2^resolution bits per sample
+                 'keep_offset',   # Capacitor ordered (True) or time ordered (False)
+                 'partial',       # Shipped without all of its data
+                 'chan_ids',      # Channel identifiers, one per row
+                 'amplitudes',    # (channels x samples) float array
+                 'stops',         # Stop sample (drs4_offset) for each row
+                 'masked',        # (channels x samples) bool array, True where amplitudes are NaN
+                 'times')         # (channels x samples) time axis, if timing calibrated (else None)
+
+    def __init__(self, evt_number, board_id, resolution, keep_offset, chan_ids, amplitudes, stops, partial=False, masked=None, times=None, timestamp=0):
+
+        self.evt_number = evt_number
+        self.board_id = board_id
+        self.timestamp = timestamp
+        self.resolution = resolution
+        self.keep_offset = keep_offset
+        self.partial = partial
+        self.chan_ids = chan_ids
+        self.amplitudes = amplitudes
+        self.stops = stops
+        self.masked = np.isnan(amplitudes) if masked is None else masked
+        self.times = times
+
+    #
+    # An independent copy
+    # (events from an eventqueue are views into shared memory, so keep a copy
+    #  if you want to hold onto one past task_done())
+    #
+    def copy(self):
+        return event(self.evt_number, self.board_id, self.resolution, self.keep_offset,
+                     self.chan_ids.copy(), self.amplitudes.copy(), self.stops.copy(), self.partial,
+                     self.masked.copy(), None if self.times is None else self.times.copy(), self.timestamp)
+
+    #
+    # Channel to amplitudes mapping (rows are views, so writes go through)
+    #
+    @property
+    def channels(self):
+        return dict(zip(self.chan_ids.tolist(), self.amplitudes))
+
+    #
+    # Channel to stop sample mapping
+    #
+    @property
+    def offsets(self):
+        return dict(zip(self.chan_ids.tolist(), self.stops.tolist()))
+
+    #
+    # Which row holds this channel?
+    #
+    def row(self, chan):
+        return self.chan_ids.tolist().index(chan)
+
+    def __getstate__(self):
+        return {name : getattr(self, name) for name in event.__slots__}
+
+    def __setstate__(self, state):
+
+        # Events pickled before the slotted record carried a dictionary
+        # of per-channel amplitude lists (or (time, amplitude) tuples)
+        if 'channels' in state:
+            state = event.convert(state)
+
+        for name in event.__slots__:
+            setattr(self, name, state.get(name))
+
+        # (and no timestamp, until the binary file format needed one)
+        if self.timestamp is None:
+            self.timestamp = 0
+
+    #
+    # Convert the attribute dictionary of an old style event
+    #
+    def convert(state):
+
+        channels = state['channels']
+        chans = list(channels.keys())
+        resolution = state.get('resolution', 4)
+
+        # Were these timing calibrated?
+        timed = len(chans) and len(channels[chans[0]]) and isinstance(channels[chans[0]][0], tuple)
+
+        fmt = lambda x : np.nan if x is None else x
+        if timed:
+            times = np.array([[t for t, ampl in channels[chan]] for chan in chans], dtype=np.float64)
+            amplitudes = np.array([[fmt(ampl) for t, ampl in channels[chan]] for chan in chans], dtype=sampleType(resolution))
+        else:
+            times = None
+            amplitudes = np.array([[fmt(ampl) for ampl in channels[chan]] for chan in chans], dtype=sampleType(resolution))
+
+        return {
+            'evt_number' : state['evt_number'],
+            'board_id' : state['board_id'],
+            'resolution' : resolution,
+            'keep_offset' : state.get('keep_offset', False),
+            'partial' : state.get('partial', False),
+            'chan_ids' : np.array(chans, dtype=np.int16),
+            'amplitudes' : amplitudes,
+            'stops' : np.array([state['offsets'][chan] for chan in chans], dtype=np.int16),
+            'masked' : np.isnan(amplitudes),
+            'times' : times
+        }
+
+# Define an event builder class
+#
+# This holds all of the state needed to assemble an event from its
+# header and hit fragments.  When complete, finish() makes the event.
+#
+class builder(object):
+
     # An internal utility class used for reconstructing
     # hit fragments
     class hitstash(object):
@@ -351,6 +908,9 @@ class event(object):
             # This will be (sample offsets, byte payloads) of individual fragments
             self.payloads = {}
 
+            # Receive pool slots holding the payloads (if any)
+            self.slots = []
+
             # The total number of samples possible 
             self.max_samples = 0
             
@@ -362,34 +922,35 @@ class event(object):
             # Sanity check
             if self.targetLength < 0:
                 # Initialize some things
-                self.targetLength = packet['hit_payload_size']
-                self.max_samples = packet['max_samples']
-                #print("New subhit stash for channel %d" % packet['channel_id'], file=sys.stderr)
+                self.targetLength = packet.hit_payload_size
+                self.max_samples = packet.max_samples
+                #print("New subhit stash for channel %d" % packet.channel_id, file=sys.stderr)
                 
             else:
                 # Verify it
-                if not self.targetLength == packet['hit_payload_size']:
+                if not self.targetLength == packet.hit_payload_size:
                     raise Exception("Inconsistent total hit payload length, not stashing packet!")
 
-                if not self.max_samples == packet['max_samples']:
+                if not self.max_samples == packet.max_samples:
                     raise Exception("Inconsistent total samples count (e.g. bad footer), not stashing packet!")
 
             # Make sure there are no dups
-            if packet['seq'] in self.payloads:
+            if packet.seq in self.payloads:
                 raise Exception("Duplicate fragment received!")
 
             # We will eventually sort by the sequence number once we have all the packets
-            self.payloads[packet['seq']] = (packet['drs4_offset'], packet['payload'])
+            self.payloads[packet.seq] = (packet.drs4_offset, packet.payload)
+            self.slots.append(packet.slot)
 
             # Remember that we got it
-            self.receivedBytes += len(packet['payload'])
+            self.receivedBytes += len(packet.payload)
 
             # Sanity check it
             if self.receivedBytes > self.targetLength:
                 print(packet)
                 raise Exception("Received %d of expected %d bytes!  Too many!" % (self.receivedBytes, self.targetLength))
 
-            #            print("Stashed seq %d for channel %d with %d bytes.  %d remaining bytes" % (packet['seq'], packet['channel_id'], len(packet['payload']), self.targetLength - self.receivedBytes), file=sys.stderr)
+            #            print("Stashed seq %d for channel %d with %d bytes.  %d remaining bytes" % (packet.seq, packet.channel_id, len(packet.payload), self.targetLength - self.receivedBytes), file=sys.stderr)
                   
         def completed(self):
             return self.receivedBytes == self.targetLength
@@ -449,8 +1010,7 @@ class event(object):
             # Make the total payload as a byte array
             subhit_total_payload = bytearray(subhit_payload_size)
         
-            # [We use hasattr() here because the code reads better than "if not event.unpacker or trying to catch some weird language exception"]
-            if not hasattr(event, 'unpacker'):
+            if event.resolution >= 3:
 
                 # How many bytes do we get for each amplitude?
                 mul = 1 << (event.resolution - 3)
@@ -462,6 +1022,7 @@ class event(object):
                 # We are doing compression
                 j = 0
                 mul = 1 << (3 - event.resolution)
+                packer = getPacker(event.resolution)
                 for i in range(0, len(amplitudes) >> (3 - event.resolution)):
 
                     # This should contain a single byte when done
@@ -469,7 +1030,7 @@ class event(object):
                     #
                     # XXX
                     # This will shit out on signed quantities
-                    compressed = event.unpacker.pack(*amplitudes[i*mul:(i+1)*mul])
+                    compressed = packer.pack(*amplitudes[i*mul:(i+1)*mul])
                     subhit_total_payload[j] = compressed[0]
                     j += 1
             
@@ -480,7 +1041,7 @@ class event(object):
             # Set things that are common to all fragments
             fragment['magic'] = HIT_MAGIC
             fragment['resolution'] = event.resolution
-            fragment['trigger_timestamp_l'] = event.raw_packet['trigger_timestamp_l']
+            fragment['trigger_timestamp_l'] = event.raw_packet.trigger_timestamp_l
             fragment['channel_id'] = chan
 
             # Now populate individual fragments
@@ -553,8 +1114,8 @@ class event(object):
         event_packet['trigger_timestamp_l'] = random.getrandbits(32)
 
         # Generate the event object
-        # (we do this since it makes the bit packer/unpacker for us)
-        testEvent = event(event_packet)
+        # (from the header as it would be received)
+        testEvent = builder(eventheader(eventpacker.pack(event_packet)))
 
         # Hack in the maximum sample
         testEvent.max_sample = max_sample
@@ -564,9 +1125,9 @@ class event(object):
 
         for chan, subhits in zip(chan_list, subhits_list):
 
-            # We use extend() because event.generateHit(...) possibly returns a list of
+            # We use extend() because builder.generateHit(...) possibly returns a list of
             # hit fragments
-            hitPackets.extend(event.generateHit(testEvent, chan, subhits))
+            hitPackets.extend(builder.generateHit(testEvent, chan, subhits))
             
             # See how much size this added to the event
             # any fragment will work, so use the last one
@@ -593,7 +1154,7 @@ class event(object):
         raw_packets.append(eventpacker.pack(event_packet))
         return raw_packets
             
-    def __init__(self, packet, keep_offset=False, activePedestal=None, activeTiming=None, mask=0):
+    def __init__(self, packet, keep_offset=False, activePedestal=None, activeTiming=None, mask=0, pool=None, timeout=None):
 
         # Store a reference to the packet
         self.raw_packet = packet
@@ -602,25 +1163,36 @@ class event(object):
         # This will be used by higher levels to aggreate many responses from many boards.
         # Presumably, this number is synchronized via other external
         # means across all participating boards.
-        self.evt_number = packet['evt_number']
+        self.evt_number = packet.evt_number
 
         # Store the board id, jesus
-        self.board_id = packet['board_id']
+        self.board_id = packet.board_id
+
+        # The full trigger timestamp
+        self.timestamp = (packet.trigger_timestamp_h << 32) | packet.trigger_timestamp_l
         
         # Keep track of our ... greatest hits ;)
+        # (hitstash objects while assembling, and then their row)
         self.channels = {}
 
+        # Translated hits are written straight into rows of this array
+        # (allocated when we know how many samples there are)
+        self.amplitudes = None
+        self.chan_ids = np.zeros(packet.num_hits, dtype=np.int16)
+        self.stops = np.zeros(packet.num_hits, dtype=np.int16)
+        self.rows = 0
+
         # How many hit channels am I expecting?
-        self.remaining_hits = packet['num_hits']
+        self.remaining_hits = packet.num_hits
 
         # How many totla bytes am I expecting?
-        self.remaining_bytes = packet['evt_size']
+        self.remaining_bytes = packet.evt_size
         
         # Has all of my data arrived?
         self.complete = False
 
-        # A list of offsets measured for each channel
-        self.offsets = {}
+        # Was I shipped without all of my data?
+        self.partial = False
 
         # Should I keep any offsets present in the data?
         self.keep_offset = keep_offset
@@ -633,9 +1205,15 @@ class event(object):
 
         # Am I applying timing calibration?
         self.activeTiming = activeTiming
+
+        # Where do my hit payloads live?
+        self.pool = pool
         
         # When was I made (profiling debugging)
         self.start = time.time()
+
+        # When do I give up on the rest of my data? (monotonic clock)
+        self.deadline = time.monotonic() + timeout if timeout else None
         
         # Protocol encodes resolution at the event level
         # (Technically, its a channel property.)
@@ -648,21 +1226,7 @@ class event(object):
         #    6 -> 64-bit data (8 bytes/sample)
         #    > 7  ERROR
         #
-        self.resolution = packet['adc_bit_width']
-
-        # Set up the unpacker for this event (so we don't make it and tear
-        # it down many times needlessly)
-        #
-        # OOO We should turn this into a factory, so this is only ever
-        # compiled once...
-        #
-        if self.resolution < 3:
-            # Then we only need to look at a byte at a time
-            self.chunks = 0
-            self.unpacker = bitstruct.compile(" ".join(["s%d" % (1 << self.resolution)] * (8 >> self.resolution)))
-        else:
-            # Then we need to be gluing bytes together (or copying)
-            self.chunks = 1 << (self.resolution - 3)
+        self.resolution = packet.adc_bit_width
 
     #
     # Determine a signature for this event, once it is complete.
@@ -678,11 +1242,15 @@ class event(object):
     #
     def claim(self, packet):
 
-        #print("Claiming a hit from %s with timestamp %d" % (packet['addr'], packet['trigger_timestamp_l']), file=sys.stderr)
+        #print("Claiming a hit from %s with timestamp %d" % (packet.addr, packet.trigger_timestamp_l), file=sys.stderr)
 
         # Sanity check the length
-        if len(packet['payload']) == 0:
+        if len(packet.payload) == 0:
             
+            # Nothing will hold onto it, so give back its receive slot
+            if self.pool:
+                self.pool.release(packet.slot)
+
             # Raise an exception with the bad packet attached
             e = Exception("Received an empty payload...")
             print(packet, file=sys.stderr)
@@ -690,32 +1258,44 @@ class event(object):
             raise e
 
         # Route this hit to the appropriate channel
-        if packet['channel_id'] in self.channels:
+        try:
+            if packet.channel_id in self.channels:
 
-            #print("Hit fragment %d routed to existing channel %d" % (packet['seq'], packet['channel_id']), file=sys.stderr)
+                #print("Hit fragment %d routed to existing channel %d" % (packet.seq, packet.channel_id), file=sys.stderr)
 
-            # Store this fragment in this channel's hit stash
-            self.channels[packet['channel_id']].stash(packet)
-            
-        else:
-            #print("Hit establishing data for channel %d, via fragment %d" % (packet['channel_id'], packet['seq']), file=sys.stderr)
+                # Store this fragment in this channel's hit stash
+                self.channels[packet.channel_id].stash(packet)
 
-            # This is the first fragment
-            self.channels[packet['channel_id']] = event.hitstash(packet)
+            else:
+                #print("Hit establishing data for channel %d, via fragment %d" % (packet.channel_id, packet.seq), file=sys.stderr)
+
+                # This is the first fragment
+                self.channels[packet.channel_id] = builder.hitstash(packet)
+
+        except Exception:
+            # If the fragment was rejected (e.g. a duplicate) before a stash kept
+            # its receive slot, nothing else will ever give the slot back
+            if self.pool and not packet.slot in getattr(self.channels.get(packet.channel_id), 'slots', ()):
+                self.pool.release(packet.slot)
+            raise
             
         # A quick alias
-        current_hit = self.channels[packet['channel_id']]
+        current_hit = self.channels[packet.channel_id]
         
         # Did we complete a hit reconstruction with this packet?
         if current_hit.completed():
             # Remove these bytes from the total expected over all channels
             self.remaining_bytes -= current_hit.receivedBytes
             
-            #print("All expected hit bytes received on channel %d.  Unpacking..." % packet['channel_id'], file=sys.stderr)
+            #print("All expected hit bytes received on channel %d.  Unpacking..." % packet.channel_id, file=sys.stderr)
 
-            # Overwrite the reference to this hitstash object with the final amplitudes list
+            # Overwrite the reference to this hitstash object with the row holding its amplitudes
             # This should eventually garbage collect the hitstash object...
-            self.channels[packet['channel_id']] = self.translate(current_hit, packet['channel_id'])
+            self.channels[packet.channel_id] = self.translate(current_hit, packet.channel_id)
+
+            # The payloads have been copied out, so their receive slots are free
+            if self.pool:
+                self.pool.release(*current_hit.slots)
 
             # Track that we finished one of the expected hits
             self.remaining_hits -= 1
@@ -731,7 +1311,60 @@ class event(object):
         return True
 
     #
-    # This converts a channel (as a hitstash object) into a Python integer list 
+    # This event is never going to complete, so translate whatever hits
+    # it has.  Missing fragments become None, and channels that never
+    # received a single fragment are absent (the header only gives their count).
+    #
+    def salvage(self):
+
+        for channel, current_hit in list(self.channels.items()):
+            if isinstance(current_hit, builder.hitstash):
+                self.channels[channel] = self.translate(current_hit, channel)
+
+                if self.pool:
+                    self.pool.release(*current_hit.slots)
+
+        # Flag it, and let it ship
+        self.partial = True
+        self.complete = True
+
+    #
+    # This event is being dropped, so give back any receive slots
+    # still held by incomplete hits
+    #
+    def discard(self):
+        if not self.pool:
+            return
+
+        for current_hit in self.channels.values():
+            if isinstance(current_hit, builder.hitstash):
+                self.pool.release(*current_hit.slots)
+
+    #
+    # Claim the next free row for this channel
+    #
+    def allocate(self, channel, max_samples):
+
+        # First hit to complete decides the number of samples
+        if self.amplitudes is None:
+            self.amplitudes = np.full((len(self.chan_ids), max_samples), np.nan, dtype=sampleType(self.resolution))
+
+        # HACKY because, in principle, the protocol supports different
+        # numbers of samples on each channel
+        if not self.amplitudes.shape[1] == max_samples:
+            raise Exception("Channel %d has %d samples, but this event has %d per channel" % (channel, max_samples, self.amplitudes.shape[1]))
+
+        if self.rows == len(self.chan_ids):
+            raise Exception("Received more hits than the %d announced in the event header" % len(self.chan_ids))
+
+        row = self.rows
+        self.rows += 1
+        self.chan_ids[row] = channel
+        return row
+
+    #
+    # This converts a channel (as a hitstash object) into a row of amplitudes,
+    # and returns the row index
     #
     # OOO 2
     #  1)  2^x modulo *can* be done fast...
@@ -749,169 +1382,392 @@ class event(object):
         # (With the sequence numbers being fully incremental, you'll be able to
         #  reconstruct capacitor positions, but not have any time reference.)
         #print("Setting the overall offset for channel %d to %d" % (packet['channel_id'], subhits[0][0]), file=sys.stderr)
-        self.offsets[channel] = subhits[0][0]
+        max_samples = current_hit.max_samples
+        stop = subhits[0][0]
 
-        # Allocate space for the entire dero
-        # Store None's 
-        amplitudes = [None] * current_hit.max_samples
+        row = self.allocate(channel, max_samples)
+        self.stops[row] = stop
+
+        # Space for the entire dero is already there
+        # (it starts out as NaN's)
+        amplitudes = self.amplitudes[row]
+
+        # Are we trying to zero offset?
+        # If so, the first sampled capacitor position (in time) goes first.
+        # Rather than assembling in capacitor order and rotating a copy
+        # afterwards, everything below is written through the rotation.
+        shift = 0 if self.keep_offset else stop % max_samples
         
         # Assign by slicing directly into the amplitudes
         # OOO we can write torn offsets directly here
         for offset, ampls in subhits:
             
-            # DDD
-            # print(ampls, file=sys.stderr)
-            
             #print("\tWriting at offset %d" % offset, ampls, file=sys.stderr)
-            # Don't know how much optimiation python does with minimizing the number of
-            # lookups on len, which is O(N)...
-            len_ampls = len(ampls)
-            end = offset + len_ampls
+            start = (offset - shift) % max_samples
+            end = start + len(ampls)
 
             # Slice it in, if we don't overrun
-            if end < current_hit.max_samples:
-                amplitudes[offset:end] = ampls
+            if end <= max_samples:
+                amplitudes[start:end] = ampls
             else:
                 # Slice in what we can at the end...
-                # XXX off by 1?
-                overrun = end - current_hit.max_samples
-                fit = current_hit.max_samples - offset
-                amplitudes[offset:current_hit.max_samples] = ampls[:fit]
+                fit = max_samples - start
+                amplitudes[start:] = ampls[:fit]
 
                 # ... and slice the rest in at the front
-                amplitudes[:overrun] = ampls[fit:]
+                amplitudes[:end - max_samples] = ampls[fit:]
 
-        # All subhits are now in place in a mutable list.
+        # All subhits are now in place in the row.
                 
-        # Are we pedestalling?  Do it now before we adjust the zero offset
+        # Are we pedestalling?
         if self.activePedestal:
-            #print("Subtracting pedestals from data before taring...", file=sys.stderr)
-            #amplitudes =
-            self.activePedestal.subtract(amplitudes, channel)
+            self.activePedestal.subtract(amplitudes, channel, shift)
             
-        # Mask out the naughty ones to the left of stop.
+        # Mask out the naughty ones around the stop.
         # This is because stop is t_max, and things get munged
         # during the stop process
-        p = subhits[0][0]
-        masklen = 5
+        amplitudes[(stop - shift + getMask(self.mask)) % max_samples] = np.nan
 
-        for i in range(0, masklen):
+        return row
 
-            # Right mask
-            amplitudes[p + i] = None
+    #
+    # Make the event record out of everything we've assembled
+    #
+    def finish(self):
 
-            if p + (i + 1) == current_hit.max_samples:
-                p = -(i + 1)
+        # Channels that never showed up (partial events) have no row
+        amplitudes = self.amplitudes[:self.rows] if not self.amplitudes is None else np.zeros((0, 0), dtype=sampleType(self.resolution))
+        chan_ids = self.chan_ids[:self.rows]
+        stops = self.stops[:self.rows]
 
-        p = subhits[0][0]
-        for i in range(0, self.mask):
+        # Rows are filled as hits complete, so put them in channel order
+        if np.any(np.diff(chan_ids) < 0):
+            order = np.argsort(chan_ids, kind='stable')
+            amplitudes, chan_ids, stops = amplitudes[order], chan_ids[order], stops[order]
 
-            # Left mask?
-            amplitudes[p - i] = None
-            
-            if p - (i + 1) < 0:
-                p = current_hit.max_samples + i
-         
-        # # Are we trying to zero offset?
-        if not self.keep_offset:
-
-            # This is the first sampled capacitor position, in time
-            tare = subhits[0][0]
-            #print("Taring the final amplitude list by %d..." % tare, file=sys.stderr)
-                
-            # Since we are not memory limited in 2019, just do an offset copy
-            tmp = [0]*(current_hit.max_samples)
+        return event(self.evt_number, self.board_id, self.resolution, self.keep_offset, chan_ids, amplitudes, stops, self.partial, timestamp=self.timestamp)
 
-            # Minimize computations
-            delta = current_hit.max_samples - tare
+        
+    #
+    # Return an int array based on the provided payload.
+    # Uses the current event's resolution and unpacking
+    # (always a NumPy array, see getDecoder())
+    #
+    def unpack(self, payload):
 
-            # Do the head of the final list...
-            tmp[:delta] = amplitudes[tare:current_hit.max_samples]
+        # Gluing bytes into integers and unpacking bits into integers
+        # both go through the (shared) decoder registry
+        return getDecoder(self.resolution, len(payload))(payload)
 
-            # ... and the tail
-            tmp[delta:] = amplitudes[0:tare]
+#
+# A ring of fixed-size event slots in shared memory.
+#
+# Each intake process writes completed events into its own ring, and only
+# (port, slot) travels over the event queue.  The consumer reads the event
+# in place, as NumPy views into the slot, and the slot is given back when
+# the consumer calls task_done().  Slots are written and released in order,
+# so the ring only needs a head and a count of free slots.
+#
+class eventring(object):
 
-            # Replace amplitudes
-            amplitudes = tmp
+    # Header fields, stored as int64 at the front of each slot
+    HEADER = ('evt_number', 'resolution', 'keep_offset', 'partial', 'nchan', 'nsamples', 'timed', 'board_id', 'timestamp_h', 'timestamp_l')
 
-        return amplitudes
+    def __init__(self, slots, max_channels, max_samples=1024, timed=False, context=None):
+
+        self.slots = slots
+        self.max_channels = max_channels
+        self.max_samples = max_samples
+        self.timed = timed
+
+        # Make the shared block and view it
+        self.shm = shared_memory.SharedMemory(create=True, size=sum(nbytes for name, dtype, count, nbytes in self.layout()))
+        self.view()
+
+        # Free slot accounting, shared between producer and consumer
+        # (from the same context as the processes, or it won't pickle into them)
+        self.free = (context or multiprocessing.get_context()).Semaphore(slots)
+
+        # Producer side: next slot to write
+        self.head = 0
+
+        # Who made me (and so, who cleans up)
+        self.owner = getpid()
 
-        
     #
-    # Return an int array based on the provided payload.
-    # Uses the current event's resolution and unpacking
+    # Lay out the slot arrays back to back (each block is a multiple of 8 bytes)
+    # Gives (name, dtype, count per slot, total bytes)
     #
-    def unpack(self, payload):
-        tmp = None
+    def layout(self):
 
-        # See if we are gluing bytes into integers
-        # or unpacking bits into integers
-        if self.chunks > 0:
+        size = self.max_channels*self.max_samples
+        layout = [('headers', np.int64, len(eventring.HEADER)),
+                  ('chan_ids', np.int16, self.max_channels + (-self.max_channels % 4)),
+                  ('stops', np.int16, self.max_channels + (-self.max_channels % 4)),
+                  ('amplitudes', np.float32, size + (size & 1)),
+                  ('masked', np.bool_, size + (-size % 8))]
+        if self.timed:
+            layout.append(('times', np.float64, size))
 
-            tmp = doit.unpack(payload)
-            # Populate the list
-            # SLOW AS BALLS
-            #tmp = [int.from_bytes(payload[i*self.chunks:(i+1)*self.chunks], byteorder='big', signed=True) for i in range(0, len(payload) >> (self.resolution - 3))]
+        return [(name, dtype, count, np.dtype(dtype).itemsize*count*self.slots) for name, dtype, count in layout]
 
-        else:
-            # OOO
-            # We should technically do a computation here too and not use append...
-            tmp = []
-
-            # We are unpacking bits (or making single u8s)
-            for i in range(0, len(payload)):
-                # Notice that we do an [i:i+1] slide, instead of an index.
-                # The index would return an integer, but the slice returns a bytes object with a single byte.
-                amplitudes = self.unpacker.unpack(payload[i:i+1])
-                for ampl in amplitudes:
-                    tmp.append(ampl)
-            
-        # Return the unpacked payload
-        return tmp
+    #
+    # Point the slot arrays into the shared block
+    #
+    def view(self):
+
+        offset = 0
+        for name, dtype, count, nbytes in self.layout():
+            setattr(self, name, np.ndarray((self.slots, count), dtype=dtype, buffer=self.shm.buf, offset=offset))
+            offset += nbytes
+
+    #
+    # Under spawn or forkserver, the ring gets pickled into the intake processes.
+    # Send only the name of the shared block (and the geometry), and reattach to
+    # it on the other side.  Otherwise, the child writes into a private copy
+    # and the consumer never sees a thing.
+    #
+    def __getstate__(self):
 
-def export(anevent, eventQueue, dumpFile):
+        state = self.__dict__.copy()
+        for name, dtype, count, nbytes in self.layout():
+            del state[name]
+        state['shm'] = self.shm.name
 
-    # For profiling of event reconstruction and
-    # queueing
-    anevent.finish = time.time()
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+        self.view()
 
     #
-    # Recover as much space as possible
-    # OOO Might be better to make an event nucleus
-    #     and just send the nucleus
+    # (Producer) Copy an event into the next slot.
+    # Returns the slot, or None if the event doesn't fit or the ring is full.
     #
-    del(anevent.remaining_hits,
-        anevent.complete,
-        anevent.chunks,
-        anevent.raw_packet,
-        anevent.activePedestal)
-    
-    if hasattr(anevent, 'unpacker'):
-        del(anevent.unpacker)
+    def write(self, anevent):
+
+        nchan, nsamples = anevent.amplitudes.shape
+
+        if not anevent.amplitudes.dtype == np.float32 or nchan > self.max_channels or nsamples > self.max_samples:
+            return None
+
+        if not anevent.times is None and not self.timed:
+            return None
+
+        if not self.free.acquire(block=False):
+            return None
+
+        slot = self.head
+        self.head = (self.head + 1) % self.slots
+
+        size = nchan*nsamples
+        self.headers[slot] = (anevent.evt_number, anevent.resolution, anevent.keep_offset, anevent.partial,
+                              nchan, nsamples, not anevent.times is None, int.from_bytes(anevent.board_id, byteorder='big'),
+                              anevent.timestamp >> 32, anevent.timestamp & 0xffffffff)
+        self.chan_ids[slot, :nchan] = anevent.chan_ids
+        self.stops[slot, :nchan] = anevent.stops
+        self.amplitudes[slot, :size] = anevent.amplitudes.reshape(-1)
+        self.masked[slot, :size] = anevent.masked.reshape(-1)
+        if not anevent.times is None:
+            self.times[slot, :size] = anevent.times.reshape(-1)
+
+        return slot
+
+    #
+    # (Consumer) Make an event out of views into a slot
+    #
+    def read(self, slot):
+
+        evt_number, resolution, keep_offset, partial, nchan, nsamples, timed, board_id, timestamp_h, timestamp_l = self.headers[slot].tolist()
+        size = nchan*nsamples
+        shape = (nchan, nsamples)
+
+        return event(evt_number, board_id.to_bytes(6, byteorder='big'), resolution, bool(keep_offset),
+                     self.chan_ids[slot, :nchan], self.amplitudes[slot, :size].reshape(shape), self.stops[slot, :nchan],
+                     bool(partial), self.masked[slot, :size].reshape(shape),
+                     self.times[slot, :size].reshape(shape) if timed else None, (timestamp_h << 32) | timestamp_l)
+
+    #
+    # (Consumer) Give back the oldest slot
+    #
+    def release(self):
+        self.free.release()
+
+    def close(self):
+        if getpid() == self.owner:
+            self.shm.close()
+            self.shm.unlink()
+
+#
+# A drop-in for the JoinableQueue between intake processes and the consumer,
+# moving events through shared memory rings (see eventring) when it can.
+# Anything else (control messages, events that don't fit) is pickled as usual.
+#
+class eventqueue(object):
+
+    def __init__(self, context=None):
+
+        # Everything shared with the intake processes must come
+        # from the context that starts them
+        self.context = context or multiprocessing.get_context()
+
+        # The control channel
+        self.queue = self.context.JoinableQueue()
+
+        # port -> ring
+        self.rings = {}
+
+        # (Producer) the ring we write into
+        self.ring = None
+        self.port = None
+
+        # (Consumer) rings holding the events we've handed out, in order
+        self.pending = collections.deque()
+
+    #
+    # Make a ring for the intake process on this port
+    # (must happen before the intake processes are started)
+    #
+    def open(self, port, slots, max_channels, max_samples=1024, timed=False):
+
+        if not self.rings:
+            atexit.register(self.close)
+
+        self.rings[port] = eventring(slots, max_channels, max_samples, timed, self.context)
+
+    #
+    # (Producer) write into the ring for this port, if there is one
+    #
+    def attach(self, port):
+        self.ring = self.rings.get(port)
+        self.port = port
+
+    def put(self, item, block=True, timeout=None):
+
+        if self.ring and isinstance(item, event):
+            slot = self.ring.write(item)
+            if not slot is None:
+                item = (self.port, slot)
+
+        self.queue.put(item, block, timeout)
+
+    def get(self, block=True, timeout=None):
+
+        item = self.queue.get(block, timeout)
+
+        if isinstance(item, tuple):
+            ring = self.rings[item[0]]
+            self.pending.append(ring)
+            return ring.read(item[1])
+
+        self.pending.append(None)
+        return item
+
+    #
+    # Done with the oldest item we handed out, so its slot can be reused
+    #
+    def task_done(self):
+
+        if self.pending:
+            ring = self.pending.popleft()
+            if ring:
+                ring.release()
+
+        self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+
+    def cancel_join_thread(self):
+        self.queue.cancel_join_thread()
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+
+#
+# Check that events written into a ring by a child process come out
+# intact on this side, for the given start method.
+# Raises if they don't.
+#
+#  python3 -c "import lappdProtocol; lappdProtocol.verifyRing('spawn')"
+#
+def ringChild(eventQueue, port, events):
+    eventQueue.attach(port)
+    for anevent in events:
+        eventQueue.put(anevent)
+
+def verifyRing(method='spawn', trials=8):
+
+    ctx = multiprocessing.get_context(method)
+
+    events = []
+    for n in range(trials):
+        nchan = random.randint(1, 8)
+        amplitudes = np.random.normal(size=(nchan, 1024)).astype(np.float32)
+        events.append(event(n, bytes(random.getrandbits(8) for i in range(6)), 14, False,
+                            np.arange(nchan, dtype=np.int16), amplitudes,
+                            np.random.randint(0, 1024, size=nchan).astype(np.int16),
+                            masked=amplitudes > 1.0, times=np.cumsum(np.ones(amplitudes.shape), axis=1),
+                            timestamp=random.getrandbits(64)))
+
+    eventQueue = eventqueue(ctx)
+    eventQueue.open(1338, trials, 8, timed=True)
+
+    child = ctx.Process(target=ringChild, args=(eventQueue, 1338, events))
+    child.start()
+
+    for sent in events:
+        got = eventQueue.get(timeout=30)
+        if not isinstance(got, event):
+            raise Exception("Ring (%s) gave back %s instead of an event" % (method, type(got)))
+        for field in ('evt_number', 'board_id', 'resolution', 'keep_offset', 'partial', 'timestamp'):
+            if not getattr(got, field) == getattr(sent, field):
+                raise Exception("Ring (%s) event field %s came back as %s, sent as %s" % (method, field, getattr(got, field), getattr(sent, field)))
+        for field in ('chan_ids', 'stops', 'amplitudes', 'masked', 'times'):
+            if not np.array_equal(getattr(got, field), getattr(sent, field)):
+                raise Exception("Ring (%s) event field %s came back different" % (method, field))
+        eventQueue.task_done()
+
+    child.join()
+    eventQueue.close()
+
+    print("Ring (%s) carried %d events from a child intact" % (method, trials), file=sys.stderr)
+
+def export(assembly, eventQueue, dumpFile, pedestalSamples=None):
+
+    # Only the event record leaves, none of the assembly state
+    anevent = assembly.finish()
 
     # Apply the timing calibration if its present
-    if anevent.activeTiming:
+    if assembly.activeTiming:
         # Compute the timing calibration
         # timemap = anevent.activeTiming.compute(anevent)
                         
         # Apply the timing calibration
-        anevent.activeTiming.apply(anevent)
+        assembly.activeTiming.apply(anevent)
 
         # Shift everything over
-        anevent.activeTiming.timeorder(anevent)
+        assembly.activeTiming.timeorder(anevent)
 
-    # Now remove these
-    del(anevent.activeTiming)
+    # Building a pedestal?  Then the event goes no further than here.
+    # (events missing channels can't go into it)
+    if pedestalSamples:
+        if not anevent.partial:
+            pedestalSamples.add(anevent)
+        return
 
     try:
         
         # Push it to another process?
         if dumpFile:
-            pickle.dump(anevent, dumpFile)
+            dumpFile.write(anevent)
             # eventQueue.put(anevent.evt_number, block=False)
         else:
             # There's always a queue for controlling the processes
-            anevent.prequeue = time.time()
             eventQueue.put(anevent, block=False)
 
     except queue.Full as e:
@@ -947,19 +1803,76 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
     # Start listening
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.bind((socket.gethostbyname(listen_tuple[0]), listen_tuple[1]))
+
+    # Datagrams are received straight into preallocated buffers
+    pool = packetpool(LAPPD_POOL_SLOTS)
     
     # Keep track of events in progress and hits that don't belong to any events
     currentEvents = collections.OrderedDict()
     numCurrentEvents = 0
 
-    # Only keep track of at most ~2e6 orphans (~1Gig) before we start dropping
-    # deque doesn't like to be list comprehended
-    orphanedHits = [] #collections.deque(maxlen=10000)
+    # Hits without an event yet, indexed by tag.
+    # Bounded in count and in age, so it can't grow without limit.
+    orphanedHits = orphanage(args.orphans, args.orphan_age, pool)
+
+    # Events that time out are either exported as partial events, or dropped
+    staleExported = 0
+    staleDropped = 0
+
+    #
+    # Retire events that are past their deadline (or the oldest one, if forced).
+    # currentEvents is in arrival order, so only its front ever needs checking.
+    #
+    def retire(now, force=False):
+        nonlocal maxEvents, numCurrentEvents, staleExported, staleDropped
+
+        while currentEvents and not maxEvents == 0:
+
+            tag, old = next(iter(currentEvents.items()))
+            if not force and now < old.deadline:
+                break
+
+            # Only force out one
+            force = False
+
+            del(currentEvents[tag])
+            numCurrentEvents -= 1
+
+            if args.stale == 'export':
+                # Ship what we have, flagged
+                old.salvage()
+
+                # (unless not a single hit made it, then there is nothing to ship)
+                if old.rows:
+                    maxEvents -= 1
+                    export(old, eventQueue, args.file, pedestalSamples)
+                    staleExported += 1
+                else:
+                    staleDropped += 1
+            else:
+                # Give back its receive slots, and
+                # this should delete all references to the hitstash inside the object
+                old.discard()
+                staleDropped += 1
+
+    # Wake up periodically, even if nothing arrives, to retire stale events
+    s.settimeout(args.event_timeout/2)
 
     # Open the dumpfile, if we were requested to make one
+    # (see lappdFile for the format)
     if args.file:
-        args.file = open("%s_%d" % (args.file, listen_tuple[1]), "wb")
+        import lappdFile
+        args.file = lappdFile.writer(open("%s_%d" % (args.file, listen_tuple[1]), "wb"),
+                                     sorted(map(int, args.channels.split())) if args.channels else None)
         
+    # Write events into our own shared memory ring, if we were given one
+    if isinstance(eventQueue, eventqueue):
+        eventQueue.attach(listen_tuple[1])
+
+    # In pedestal mode, events are reduced to statistics right here,
+    # and only those go to the parent (see accumulator.merge())
+    pedestalSamples = accumulator() if args.pedestal else None
+
     # Release the semaphore lock
     print("(PID %d): Releasing initialization lock for port %d..." % (pid, listen_tuple[1]), file=sys.stderr)
     msg = Exception()
@@ -978,25 +1891,43 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
             # Grab the maximum IP packet size
             # (and wait until things come in)
             # UDP semantics just pops whatever is there off of the packet stack
+            #
+            # We receive into a free slot of the pool, and only pass memoryviews
+            # around from here on.  Hits keep their slot until they are translated.
             #print("Waiting for packets at %s:%d..." % listen_tuple, file=sys.stderr)
-            data, addr = s.recvfrom(1500)
+            slot, buf = pool.acquire()
+            try:
+                nbytes, addr = s.recvfrom_into(buf)
+            except socket.timeout:
+                # Nothing arrived for a while, so clean up
+                # (a bad event should only cost us that event)
+                pool.release(slot)
+                try:
+                    now = time.monotonic()
+                    retire(now)
+                    orphanedHits.expire(now)
+                except Exception as e:
+                    import traceback
+                    traceback.print_exc(file=sys.stderr)
+                continue
+
+            data = buf[:nbytes]
             #print("Packet received from %s:%d!" % addr, file=sys.stderr)
 
             #
-            # Note that bitstruct is only useful for the header, 
-            # because it cannot handle arbitrary length payloads.
-            # (It is also useful for packing bits into bytes for payloads)
+            # Headers are parsed with precompiled structs (see hitheader and eventheader),
+            # and payloads are left as views into the pool slot.
             #
             # So, for hits, we have to:
-            #  1) analyze the header with bitstruct
-            #  2) move the remaining bytes, minus footer, into a payload field added to the dict returned by bitstruct
+            #  1) parse the fixed header
+            #  2) point the payload field at the remaining bytes, minus footer
             #
             # Try to unpack it as a hit first
             packet = None
             try:
                 # Get the hit header into the packet
-                packet = hitpacker.unpack(data)
-                if not packet['magic'] == HIT_MAGIC:
+                packet = hitheader(data)
+                if not packet.magic == HIT_MAGIC:
                     packet = None
                 else:
                     #print("Received a hit", file=sys.stderr)
@@ -1005,14 +1936,16 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
                     #print(packet, file=sys.stderr)
                     
                     # Since we've got a hit, there are more bytes to deal with
-                    packet['payload'] = data[HIT_HEADER_SIZE:-2]
+                    # (this is a view, the bytes stay in the pool slot)
+                    packet.payload = data[HIT_HEADER_SIZE:-2]
+                    packet.slot = slot
 
                     # Interpret the footer as the total number of samples possible within this data
-                    packet['max_samples'] = int.from_bytes(data[-2:], byteorder='big')
+                    packet.max_samples = int.from_bytes(data[-2:], byteorder='big')
                     
                     # Its a hit, lets get it routed
-                    tag = (addr[0], packet['trigger_timestamp_l'])
-                    packet['addr'] = addr[0]
+                    tag = (addr[0], packet.trigger_timestamp_l)
+                    packet.addr = addr[0]
                     
                     # Do we have an event to associate this with?
                     if tag in currentEvents:
@@ -1030,7 +1963,7 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
 
                             # Track that we just shipped one
                             maxEvents -= 1
-                            export(currentEvents[tag], eventQueue, args.file)
+                            export(currentEvents[tag], eventQueue, args.file, pedestalSamples)
                             if (maxEvents & 255) == 0:
                                 print("(PID %d): Waiting for %d more events" % (pid, maxEvents), file=sys.stderr)
             
@@ -1039,20 +1972,24 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
                             
                     else:
                         # We don't belong to anyone?
-                        packet['addr'] = addr[0]
-                        orphanedHits.append(packet)
+                        orphanedHits.adopt(tag, packet)
 
                         # Notify.
-                        #print("Orphaned HIT fragment %d, channel %d, received from %s with timestamp %d" % (packet['seq'], packet['channel_id'], *tag), file=sys.stderr)
+                        #print("Orphaned HIT fragment %d, channel %d, received from %s with timestamp %d" % (packet.seq, packet.channel_id, *tag), file=sys.stderr)
             except Exception as e:
                 import traceback
                 traceback.print_exc(file=sys.stderr)
 
             # Try to parse it as an event
             if not packet:
+
+                # Event headers are not held onto, so the slot is free
+                # as soon as we are done parsing
+                pool.release(slot)
+
                 try:
-                    packet = eventpacker.unpack(data)
-                    if not packet['magic'] == EVT_MAGIC:
+                    packet = eventheader(data)
+                    if not packet.magic == EVT_MAGIC:
                         print("(PID %d): Received packet could not be parsed as either an event packet or a hit packet.  Dropping." % pid, file=sys.stderr)
                         print(packet, file=sys.stderr)
                         continue
@@ -1060,33 +1997,35 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
                         #print("Received an event", file=sys.stderr)
                         #print(packet, file=sys.stderr)
                         # Make a tuple tag for this packet so we can sort it
-                        tag = (addr[0], packet['trigger_timestamp_l'])
+                        tag = (addr[0], packet.trigger_timestamp_l)
 
                         if not tag in currentEvents:
 
-                            # print("Registering new event %d from %s, timestamp %d" % (packet['evt_number'], *tag), file=sys.stderr)
+                            # print("Registering new event %d from %s, timestamp %d" % (packet.evt_number, *tag), file=sys.stderr)
                             
                             # Make an event from this packet
-                            currentEvents[tag] = event(packet, args.offset, activePedestal, activeTiming, args.mask)
-
-                            # And remove old ones if we are overflowing
-                            # XXX This is still not finished being implemented!
+                            currentEvents[tag] = builder(packet, args.offset, activePedestal, activeTiming, args.mask, pool, args.event_timeout)
                             numCurrentEvents += 1
-                            if numCurrentEvents > 100:
-                                old = currentEvents.popitem(last=False)
 
-                                # It would be better to dump this event, even if its incomplete...
-
-                                # This should delete all references to the hitstash inside the object
-                                del(old)
+                            # Retire events that have timed out, and the oldest
+                            # if we are overflowing anyway
+                            retire(time.monotonic())
+                            if numCurrentEvents > 100:
+                                retire(time.monotonic(), force=True)
 
-                            # Lambda function which will claim a matching orphan and signal the match success
-                            claimed = lambda orphan : currentEvents[tag].claim(orphan) if (orphan['addr'], orphan['trigger_timestamp_l']) == tag else False
+                            # Claim any orphans that were waiting for this event
                             #print("Trying to claim orphans...", file=sys.stderr)
-                            # Note arcane syntax for doing an in-place mutation
-                            # (I assign to the slice, instead of to the name)
-                            #
-                            orphanedHits[:] = [orphan for orphan in orphanedHits if not claimed(orphan)]
+                            # (one bad orphan shouldn't lose the rest, and claim()
+                            #  already gives back the receive slot of any it rejects)
+                            for orphan in orphanedHits.claim(tag):
+                                try:
+                                    currentEvents[tag].claim(orphan)
+                                except Exception:
+                                    import traceback
+                                    traceback.print_exc(file=sys.stderr)
+
+                            # And forget orphans that have waited too long
+                            orphanedHits.expire()
                                                         
                             # Now, this event might have been completed by a bunch of orhpans
                             if currentEvents[tag].complete:
@@ -1094,7 +2033,7 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
 
                                 # Track that we are about to ship one
                                 maxEvents -= 1
-                                export(currentEvents[tag], eventQueue, args.file)
+                                export(currentEvents[tag], eventQueue, args.file, pedestalSamples)
 
                                 if (maxEvents & 255) == 0:
                                     print("Waiting for %d more events" % maxEvents, file=sys.stderr)
@@ -1107,7 +2046,7 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
                             print("(PID %d): Received a duplicate event (well, sequence numbers might have been different but source and low timestamp collided)" % pid, file=sys.stderr)
                             
                 
-                except bitstruct.Error as e:
+                except struct.error as e:
                     print("(PID %d): Received packet could not be parsed as either an event packet or a hit packet.  Dropping." % pid, file=sys.stderr)
                     continue
                 except Exception as e:
@@ -1122,14 +2061,6 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
         except KeyboardInterrupt:
             print("\n(PID %d): Caught SIGINT." % pid, file=sys.stderr)
 
-            # If there was a dumpFile, close it
-            if args.file:
-                print("\n(PID %d): Closing dump.." % pid, file=sys.stderr)
-                args.file.close()
-            
-            print("(PID %d): At death:\n\tOrphaned hits: %d\n\tIncomplete events: %d" % (pid, len(orphanedHits), len(currentEvents)), file=sys.stderr)
-            print("(PID %d): Remaining number of events: %d" % (pid, maxEvents), file=sys.stderr)
-
             # Permit death without pushing further data onto the pipe
             eventQueue.cancel_join_thread()
             break
@@ -1137,12 +2068,23 @@ def intake(listen_tuple, eventQueue, args): #dumpFile=None, keep_offset=False, s
             print("\nCaught some sort of instruction to die with honor, committing 切腹...", file=sys.stderr)
             break
 
-    
+    # How did it go?  (however we left the loop)
+    print("(PID %d): At death:\n\tOrphaned hits: %d (%d evicted)\n\tIncomplete events: %d" % (pid, len(orphanedHits), orphanedHits.evicted, len(currentEvents)), file=sys.stderr)
+    print("(PID %d): Receive pool: %d slots, grown %d times" % (pid, len(pool.buffers), pool.grown), file=sys.stderr)
+    print("(PID %d): Timed out events: %d exported partial, %d dropped" % (pid, staleExported, staleDropped), file=sys.stderr)
+    print("(PID %d): Remaining number of events: %d" % (pid, maxEvents), file=sys.stderr)
+
     # If we had a dump file, close it out
+    # (the only place it is closed, however we left the loop)
     if args.file:
         args.file.close()
         print("\n(PID %d): Dump file closed." % pid, file=sys.stderr)
 
+    # Ship our share of the pedestal, if we made it to the end
+    if pedestalSamples and maxEvents == 0:
+        print("(PID %d): Sending pedestal statistics over %d events" % (pid, pedestalSamples.events), file=sys.stderr)
+        eventQueue.put(pedestalSamples)
+
     # Wait for the parent to join
     #eventQueue.close()
 #
@@ -1152,26 +2094,23 @@ def dump(event):
     # # Dump the entire detection in ASCII
     print("# event number = %d\n# y_max = %d" % (event.evt_number, (1 << ((1 << event.resolution) - 1)) - 1))
 
-    # A quick formatter
-    fmt = lambda x : float('nan') if x is None else x
-
-    # See if we have tuples, or just a raw list
-    chans = list(event.channels.keys())
+    # Masked samples are NaN, and print as such
+    rows = zip(event.chan_ids.tolist(), event.stops.tolist(), event.amplitudes)
 
     # Unroll this
-    if not isinstance(event.channels[chans[0]][0], tuple):     
-        for channel, amplitudes in event.channels.items():
-            print("# BEGIN CHANNEL %d\n# drs4_offset: %d" % (channel, event.offsets[channel]))
+    if event.times is None:
+        for channel, stop, amplitudes in rows:
+            print("# BEGIN CHANNEL %d\n# drs4_offset: %d" % (channel, stop))
 
-            for n, ampl in enumerate(amplitudes):
-                print("%d %e %d" % (n, fmt(ampl), channel))
+            for n, ampl in enumerate(amplitudes.tolist()):
+                print("%d %e %d" % (n, ampl, channel))
             print("# END OF CHANNEL %d (EVENT %d)" % (channel, event.evt_number))
     else:
-        for channel, amplitudes in event.channels.items():
-            print("# BEGIN CHANNEL %d\n# drs4_offset: %d" % (channel, event.offsets[channel]))
+        for (channel, stop, amplitudes), times in zip(rows, event.times):
+            print("# BEGIN CHANNEL %d\n# drs4_offset: %d" % (channel, stop))
 
-            for t, ampl in amplitudes:
-                print("%e %e %d" % (t, fmt(ampl), channel))
+            for t, ampl in zip(times.tolist(), amplitudes.tolist()):
+                print("%e %e %d" % (t, ampl, channel))
             print("# END OF CHANNEL %d (EVENT %d)" % (channel, event.evt_number))
    
             
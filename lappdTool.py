@@ -5,9 +5,20 @@ import multiprocessing
 from os import kill
 from signal import SIGINT
 from sys import stderr
+import numpy as np
 
 import lappdIfc
-from lappdProtocol import intake
+from lappdProtocol import intake, eventqueue
+
+#
+# For times that have to be strictly positive
+# (a zero socket timeout would make the socket non-blocking)
+#
+def positive(value):
+    value = float(value)
+    if not value > 0:
+        raise argparse.ArgumentTypeError("%s is not greater than 0" % value)
+    return value
 
 #
 # Common parameters that are used by anything intaking packets
@@ -23,6 +34,7 @@ def create(leader):
     parser.add_argument('-T', '--threads', metavar="NUM_THREADS", type=int, help="Number of children to attach to distinct ports (to receive data in parallel on separate UDP buffers at the POSIX level.  Number of processors - 1 is a good choice.", default=1)
 
     parser.add_argument('-I', '--initialize', action="store_true", help="Initialize the board before taking data")
+    parser.add_argument('--recalibrate', action="store_true", help="With -I, redo the ADC IDELAY calibration instead of restoring the one cached for this board")
     parser.add_argument('-o', '--offset', action="store_true", help='Retain ROI channel offsets for incoming events.  (Order by capacitor, instead of ordering by time)')
 
     parser.add_argument('-s', '--subtract', metavar='PEDESTAL_FILE', type=str, help='Pedestal to subtract from incoming amplitude data')
@@ -34,6 +46,15 @@ def create(leader):
 
     parser.add_argument('-w', '--wait', metavar='WAIT', type=int, help="Adjust delay between receipt of soft/hard trigger and sampling stop. (Persistant)")
     parser.add_argument('-t', '--timing', metavar='TIMING_FILE', type=str, help='Output time-calibrated data (in seconds)')
+    parser.add_argument('--orphans', metavar='MAX_ORPHANS', type=int, default=100000, help='Maximum number of hit fragments held while waiting for their event header.  Oldest are dropped first.')
+    parser.add_argument('--orphan-age', metavar='SECONDS', type=float, default=1.0, help='Drop hit fragments that have waited this long for their event header')
+    parser.add_argument('--event-timeout', metavar='SECONDS', type=positive, default=0.5, help='Give up on incomplete events after this long')
+    parser.add_argument('--stale', choices=['drop', 'export'], default='drop', help='What to do with incomplete events that time out: count and drop them, or export them flagged as partial')
+    parser.add_argument('--slots', metavar='SLOTS', type=int, default=64, help='Shared memory event slots for each intake process.  0 pickles every event through the queue instead.')
+
+    # Tools that build pedestals add their own flag for it
+    # (intake processes then only send back statistics, see lappdProtocol.accumulator)
+    parser.set_defaults(pedestal=False)
 
     # At these values, unbuffered TCAL does not
     # have the periodic pulse artifact (@ CMOFS 0.8)
@@ -57,6 +78,37 @@ def create(leader):
     
     return parser
 
+#
+# Calibrations that estimate something per capacitor can stop early,
+# once enough of the capacitors are known well enough.
+# (NUM_SAMPLES then becomes the most events that will be taken)
+#
+def convergence(parser, units):
+
+    parser.add_argument('-P', '--precision', metavar='PRECISION', type=float, help='Stop once the standard error of the per capacitor estimates is below PRECISION (%s)' % units)
+    parser.add_argument('-Q', '--quantile', metavar='QUANTILE', type=float, default=0.99, help='Fraction of capacitors that must reach PRECISION before stopping.  Defaults to 0.99')
+
+#
+# Have enough capacitors reached the requested precision?
+# (errors with no estimate yet, NaN, never count)
+#
+def converged(errors, args):
+    return np.count_nonzero(errors <= args.precision) >= args.quantile*errors.size
+
+#
+# Report how far along the estimates are, and which capacitors are holding things up
+#
+def progress(errors, chan_ids, args, worst=5):
+
+    met = np.count_nonzero(errors <= args.precision)
+    print("%d of %d capacitors (%.2f%%) within %g, need %.2f%%" % (met, errors.size, 100.0*met/errors.size, args.precision, 100.0*args.quantile), file=stderr)
+
+    # Worst first (capacitors without an estimate are the worst)
+    flat = np.where(np.isnan(errors), np.inf, errors).ravel()
+    for i in np.argsort(flat)[::-1][:worst]:
+        row, cap = divmod(int(i), errors.shape[1])
+        print("\tchannel %d, capacitor %d: %e" % (chan_ids[row], cap, errors[row, cap]), file=stderr)
+
 # DAC Channel mappings (in A21 crosshacked)
 # (these should be moved to lappdIfc.py)
 DAC_BIAS = 0
@@ -76,7 +128,7 @@ def connect(parser):
 
     # Initialize the board, if requested
     if args.initialize:
-        ifc.Initialize()
+        ifc.Initialize(recalibrate=args.recalibrate)
 
     # Set the requested threads on the hardware side 
     ifc.brd.pokenow(lappdIfc.NUDPPORTS, args.threads)
@@ -86,7 +138,8 @@ def connect(parser):
     args.listen = ifc.brd.s.getsockname()[0]
 
     # Make an event queue
-    eventQueue = multiprocessing.JoinableQueue()
+    # (events themselves travel through shared memory, see spawn())
+    eventQueue = eventqueue()
 
     # Make a good (useful?) filename
     if args.file:
@@ -117,6 +170,15 @@ def connect(parser):
         ifc.brd.pokenow(0x670, low)
         ifc.brd.pokenow(0x674, high)
 
+    # Binary files need all their channels up front.  The first event written
+    # might be partial (--stale export), so take them from the board's mask
+    if args.file and not args.channels:
+        low = ifc.brd.peeknow(lappdIfc.ADCCHANMASK_0)
+        high = ifc.brd.peeknow(lappdIfc.ADCCHANMASK_0 + 4)
+        chans = [chan for chan in range(32) if low & (1 << chan)] + [chan + 32 for chan in range(32) if high & (1 << chan)]
+        args.channels = " ".join(map(str, chans))
+        print("Recording channels from the board mask: ", chans, file=stderr)
+
     # Set the wait?
     if args.wait:
         ifc.brd.pokenow(lappdIfc.DRSWAITSTART, args.wait)
@@ -162,8 +224,15 @@ def spawn(args, eventQueue):
     # Track the children
     intakeProcesses = [None]*args.threads
 
+    # Give each child a shared memory ring to put its events in.
+    # Slots are sized for the requested channels (or all 64, if we don't know)
+    if args.slots > 0 and not args.file and not args.pedestal:
+        max_channels = len(args.channels.split()) if args.channels else 64
+        for i in range(0, args.threads):
+            eventQueue.open(args.aim+i, args.slots, max_channels, 1024, bool(args.timing))
+
     for i in range(0, args.threads):
-        intakeProcesses[i] = multiprocessing.Process(target=intake, args=((args.listen, args.aim+i), eventQueue, args))
+        intakeProcesses[i] = eventQueue.context.Process(target=intake, args=((args.listen, args.aim+i), eventQueue, args))
         intakeProcesses[i].start()
 
         # Pin the processes
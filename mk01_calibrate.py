@@ -119,6 +119,11 @@ triggerToggled = False
 events = []
 import time
 
+# Pedestals are built up by the intake processes as events arrive,
+# and only their statistics come back at the end
+if args.pedestal:
+    pedestalSamples = lappdProtocol.accumulator()
+
 for i in range(0, args.N):
 
     if not args.external:
@@ -132,7 +137,8 @@ for i in range(0, args.N):
         time.sleep(args.i)
 
     # Get from event queue if we're not directly dumping to files
-    if not args.file:
+    # (or building pedestals)
+    if not args.file and not args.pedestal:
         try:
             event = eventQueue.get()
 
@@ -140,7 +146,8 @@ for i in range(0, args.N):
                 print("Received event %d" % (event.evt_number), file=sys.stderr)
                 
             # Push it onto the processing queue
-            events.append(event)
+            # (keep a copy, the original lives in shared memory that is reused after task_done())
+            events.append(event.copy())
 
             # Signal that we consumed something
             eventQueue.task_done()
@@ -148,6 +155,13 @@ for i in range(0, args.N):
         except queue.Empty:
             print("Timed out (+100ms) on soft trigger %d." % i, file=sys.stderr)
 
+# Collect the pedestal statistics from each intake process
+# (before joining, so that they can finish sending them)
+if args.pedestal:
+    for p in intakeProcesses:
+        pedestalSamples.merge(eventQueue.get())
+        eventQueue.task_done()
+
 # Wait on the intake processes to finish
 print("Waiting for intakes() to finish...", file=sys.stderr)
 for p in intakeProcesses:
@@ -162,12 +176,12 @@ print("intakes() complete.", file=sys.stderr)
 # Should we build a pedestal with these events?
 if args.pedestal:
 
-    # BEETLEJUICE BEETLEJUICE BEETLEJUICE
-    activePedestal = lappdProtocol.pedestal(events)
-
     # Write it out
-    if len(events) > 0:
-        pickle.dump(activePedestal, open("%s.pedestal" % events[0].board_id.hex(), "wb"))
+    if pedestalSamples.events > 0:
+
+        # BEETLEJUICE BEETLEJUICE BEETLEJUICE
+        activePedestal = lappdProtocol.pedestal(pedestalSamples)
+        pickle.dump(activePedestal, open("%s.pedestal" % activePedestal.board_id.hex(), "wb"))
 
 elif not args.quiet:
         
@@ -65,6 +65,9 @@ for chan in evt.channels.keys():
     lines.append(line)
     chans.append(chan)
 
+# Done with it (it lives in shared memory that is reused after task_done())
+eventQueue.task_done()
+
 ax.legend()
 zeros = [0.0]*1024
 
@@ -88,12 +91,13 @@ def animate(i):
     # for chan, ampls in evt.channels:
     currentTrigs = []
     
-    if isinstance(evt.channels[chans[0]][0], tuple):
+    if not evt.times is None:
 
         found = False
         for n,line in enumerate(lines):
-            xdata, ydata = zip(*evt.channels[chans[n]])
-            ydata = [y * args.gain if y is not None else float('nan') for y in ydata]
+            row = evt.row(chans[n])
+            xdata = evt.times[row]
+            ydata = evt.amplitudes[row] * args.gain
 
             for y in ydata:
                 if y > args.threshold:
@@ -115,8 +119,8 @@ def animate(i):
             prevTrigs = currentTrigs
     else:
         for n,line in enumerate(lines):
-            xdata, ydata = zip(*enumerate(evt.channels[chans[n]]))
-            ydata = [y * args.gain if y is not None else float('nan') for y in ydata]
+            ydata = evt.channels[chans[n]] * args.gain
+            xdata = range(len(ydata))
 
             found = False
             for y in ydata:
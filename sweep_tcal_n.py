@@ -43,22 +43,29 @@ for voltage in np.linspace(args.tcal, args.sweep, args.N):
     # Wait for it to settle
     time.sleep(args.i)
 
-    # Software trigger
-    ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
-
-    # Wait for the event
-    evt = eventQueue.get()
-
-    # Add some info and stash it
-    evt.voltage = voltage
-    evts.append(evt)
+    # Software trigger, until we get a whole event
+    # (partial events, from --stale export, are missing channels)
+    while True:
+        ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
+
+        # Wait for the event
+        evt = eventQueue.get()
+        if not evt.partial:
+            break
+
+        eventQueue.task_done()
+
+    # Stash it, along with the voltage it was taken at
+    # (keep a copy, the original lives in shared memory that is reused after task_done())
+    evts.append((voltage, evt.copy()))
+    eventQueue.task_done()
     
     # Give some output
     print("Received data for TCAL_N = %f" % voltage, file=sys.stderr)
 
 # Get the channel list
 # (the * expands the iterator)
-chans = [*evts[0].channels.keys()]
+chans = [*evts[0][1].channels.keys()]
 
 # # Dump out the events to stdout
 # for evt in evts:
@@ -96,7 +103,7 @@ if not args.subtract:
 else:
     import statistics
     # Iterate over channels, because we want response curves per channel
-    chans = evts[0].channels.keys()
+    chans = evts[0][1].channels.keys()
     curves = {}
     
     for chan in chans:
@@ -104,13 +111,13 @@ else:
         # Now we have a bunch of events, collapse down all the values into an average
         curves[chan] = []
     
-        for evt in evts:
-            # Save this data point (filtering out Nones)
-            filtered = list(filter(None, evt.channels[chan]))
+        for voltage, evt in evts:
+            # Save this data point (filtering out NaNs)
+            filtered = evt.channels[chan][~np.isnan(evt.channels[chan])]
             if not len(filtered):
-                curves[chan].append( (evt.voltage, float('nan')))
+                curves[chan].append( (voltage, float('nan')))
             else:
-                curves[chan].append( (evt.voltage, statistics.mean(filtered)))
+                curves[chan].append( (voltage, statistics.mean(filtered)))
 
     # Now output the results
     for channel, results in curves.items():
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import numpy as np
+import math
 import sys
 import time
 
@@ -16,6 +17,7 @@ parser = lappdTool.create("Build a timing calibration from TCA sine samples")
 # Since we want high precision here, add the option to correct per-capacitor gains
 parser.add_argument('-g', '--gain', metavar='GAIN_FILE',  help='Convert ADC counts into voltage using this gain profile')
 parser.add_argument('-D', '--deltas', metavar='CHIP_DELTAS_FILE', help='Input externally measured interchip timing offsets')
+lappdTool.convergence(parser, 'picoseconds')
 
 # Handle common configuration due to the common arguments
 ifc, args, eventQueue = lappdTool.connect(parser)
@@ -59,26 +61,82 @@ if args.gain:
     gainCorrection = pickle.load(open(args.gain, "rb"))
     print("Using gain file %s" % args.gain, file=sys.stderr)
 
-# Get an event
-ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
+# Get an event (a whole one, so we see every active channel)
+while True:
+    ifc.brd.pokenow(0x320, 1 << 6, readback=False, silent=True)
 
-# Wait for the event
-evt = eventQueue.get()
+    # Wait for the event
+    evt = eventQueue.get()
+    if not evt.partial:
+        break
+
+    eventQueue.task_done()
 
 # Get board id
 board_id = evt.board_id.hex()
 
 # Get board active channels
-chans = evt.channels.keys()
+chan_ids = evt.chan_ids.copy()
+chans = chan_ids.tolist()
 
-# Make the nishimura romero-wolf variables
-xij = {}
-yij = {}
+# Done with it
+eventQueue.task_done()
+
+# Per capacitor gains, as an array over the active channels
+# We multiply by 1000 to put things into milivolts
+#
+# XXX we should do this at computation of the gain calibration....
+gains = None
+if gainCorrection:
+    gains = np.array([[gain[0] for gain in gainCorrection[chan]] for chan in chans])*1000
 
-for chan in chans:
-    # Initialize the pairs list
-    xij[chan] = [0 for x in range(1024)]
-    yij[chan] = [0 for y in range(1024)]
+# Make the nishimura romero-wolf variables
+# (channels x capacitors, capacitor i pairs with i+1, and 1023 with 0)
+xij = np.zeros((len(chans), 1024))
+yij = np.zeros((len(chans), 1024))
+
+# Along with their second moments and how many pairs went into each,
+# so that we know how well we know each \Delta_{i, i+1}
+xxij = np.zeros((len(chans), 1024))
+yyij = np.zeros((len(chans), 1024))
+xyij = np.zeros((len(chans), 1024))
+nij = np.zeros((len(chans), 1024), dtype=np.int64)
+
+#
+# Assuming the integral average is a good approximation for this sample...
+# Then:
+#    atan(sqrt(<y^2>/<x^2>))/(\pi 1e8) = \Delta_{ij}
+#
+# Note: Our calibration oscillator is 100Mhz, so 1e8.
+#       We multiply by 1e9 to switch to nanoseconds
+#       So the final factor is 10 (on top)
+#
+# The standard errors (in picoseconds) come from propagating the
+# (co)variances of <x^2> and <y^2> through the ratio and the arctangent.
+#
+def estimate():
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        n = nij.astype(np.float64)
+        x = xij/n
+        y = yij/n
+        r = y/x
+
+        deltas = np.arctan(np.sqrt(r))*10/math.pi
+
+        # Variance of the ratio of the means
+        varx = xxij/n - x*x
+        vary = yyij/n - y*y
+        covxy = xyij/n - x*y
+        varr = np.maximum(vary - 2*r*covxy + r*r*varx, 0.0)/(x*x*(n - 1))
+
+        # d\Delta/dr
+        slope = 10/(math.pi*2*np.sqrt(r)*(1 + r))
+
+        errors = np.where(nij > 1, slope*np.sqrt(varr)*1000, np.nan)
+
+    return deltas, errors
 
 # Now populate them
 for k in range(0, Nsamples):
@@ -92,45 +150,55 @@ for k in range(0, Nsamples):
     # Wait for the event
     evt = eventQueue.get()
 
+    # Partial events (--stale export) are missing channels, so they can't be used
+    if evt.partial:
+        print("Skipping partial event %d" % evt.evt_number, file=sys.stderr)
+        eventQueue.task_done()
+        continue
+
     # Modestly print out status
     if k & 255 == 0:
         print("Received event %d" % k, file=sys.stderr)
 
-    # Process it right here.
-    for chan in chans:
-        # First, apply the gain correction (since we don't usually care enough about this elsewhere)
-        if gainCorrection:
-            for i in range(1024):
-                if not evt.channels[chan][i] is None:
-                    # We multiply by 1000 to put things into milivolts
-                    #
-                    # XXX we should do this at computation of the gain calibration....
-                    evt.channels[chan][i] *= gainCorrection[chan][i][0] * 1000
-            #print("Gains corrected for event number %d" % evt.evt_number, file=sys.stderr)
-        
-        # Go through the waveforms, stashing the squares already
-
-        for i in range(1023):
-            if not evt.channels[chan][i] is None and not evt.channels[chan][i+1] is None:
-                #xij[chan][i].append( (evt.channels[chan][i] + evt.channels[chan][i+1])**2 )
-                xij[chan][i] += (evt.channels[chan][i] + evt.channels[chan][i+1])**2
-                #yij[chan][i].append( (evt.channels[chan][i] - evt.channels[chan][i+1])**2 )
-                yij[chan][i] += (evt.channels[chan][i] - evt.channels[chan][i+1])**2
-            
-            # Don't forget the reach around
-            if not evt.channels[chan][1023] is None and not evt.channels[chan][0] is None:
-                #xij[chan][1023].append( (evt.channels[chan][1023] + evt.channels[chan][0])**2 )
-                xij[chan][1023] += (evt.channels[chan][1023] + evt.channels[chan][0])**2
-                #yij[chan][1023].append( (evt.channels[chan][1023] - evt.channels[chan][0])**2 )
-                yij[chan][1023] += (evt.channels[chan][1023] - evt.channels[chan][0])**2
+    # Process it right here, all channels at once.
+    if np.array_equal(evt.chan_ids, chan_ids):
+        amplitudes = evt.amplitudes.astype(np.float64)
+    else:
+        amplitudes = evt.amplitudes[[evt.row(chan) for chan in chans]].astype(np.float64)
 
-    
-    # Add some info and stash it
-    # evts.append(evt)
+    # First, apply the gain correction (since we don't usually care enough about this elsewhere)
+    if not gains is None:
+        amplitudes *= gains
+
+    # Each capacitor's neighbour (including the reach around)
+    neighbours = np.roll(amplitudes, -1, axis=1)
+
+    # Only pairs where neither sample is masked count
+    valid = ~(np.isnan(amplitudes) | np.isnan(neighbours))
+
+    # Stash the squares
+    x = np.where(valid, (amplitudes + neighbours)**2, 0.0)
+    y = np.where(valid, (amplitudes - neighbours)**2, 0.0)
+
+    xij += x
+    yij += y
+    xxij += x*x
+    yyij += y*y
+    xyij += x*y
+    nij += valid
 
     # Signal that we got it.
     eventQueue.task_done()
 
+    # Every so often, see if we know things well enough yet
+    if args.precision and k & 255 == 255:
+        deltas, errors = estimate()
+        lappdTool.progress(errors, chans, args)
+
+        if lappdTool.converged(errors, args):
+            print("Converged after %d events" % (k + 1), file=sys.stderr)
+            break
+
 # Restore old channel masks
 ifc.brd.pokenow(0x670, masklow)
 ifc.brd.pokenow(0x674, maskhigh)
@@ -146,33 +214,24 @@ lappdTool.reap(intakeProcesses, args)
 ############# END COMMON TOOL FOOTER 
 
 # Now do the analysis
-# from scipy.stats import describe
-import math
-    
-for chan in chans:
-    # Okay, now compute the averages
-    for i in range(1024):
+deltas, errors = estimate()
+
+# Say how well we did
+if args.precision:
+    lappdTool.progress(errors, chans, args)
+
+    if not lappdTool.converged(errors, args):
+        print("WARNING: Did not reach the requested precision within %d events" % Nsamples, file=sys.stderr)
 
-        # This function, computing 4 moments, is faster than just computing
-        # the damn average manually...
-        #
-        # XXX changed this from these numpy.float644's to regular python float...
-        xij[chan][i] = float(xij[chan][i]/Nsamples) #float(describe(xij[chan][i]).mean)
-        yij[chan][i] = float(yij[chan][i]/Nsamples) #float(describe(yij[chan][i]).mean)
-
-        #
-        # Assuming the integral average is a good approximation for this sample...
-        # Then:
-        #    atan(sqrt(<y^2>/<x^2>))/(\pi 1e8) = \Delta_{ij}
-        #
-        # Note: Our calibration oscillator is 100Mhz, so 1e8.
-        #       We multiply by 1e9 to switch to nanoseconds
-        #       So the final factor is 10 (on top)
-        #
-        xij[chan][i] = math.atan(math.sqrt(yij[chan][i]/xij[chan][i]))*10/math.pi
+# Back to per channel lists, for the timing object
+xij = {}
+for row, chan in enumerate(chans):
+    xij[chan] = deltas[row].tolist()
 
+    for i in range(1024):
         print("%e %d" % (xij[chan][i], chan))
-        print("Computed \Delta_{%d, %d+1} for calibration channel %d" % (i, i+1, chan), file=sys.stderr)
+
+    print("Computed \\Delta_{i, i+1} for calibration channel %d" % chan, file=sys.stderr)
 
 # Create a timing object
 